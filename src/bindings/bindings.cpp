@@ -259,6 +259,7 @@ PYBIND11_MODULE(core, m)
         .def("positioned_bounds", &Geometry::positioned_bounds)
         .def("should_draw", &Geometry::should_draw)
         .def("vertexes", &Geometry::vertexes)
+        .def("vertex_coords", &Geometry::vertex_coords)
         .def("triangles", &Geometry::triangles)
         .def("rotate_around", &Geometry::rotate_around)
         .def("stretch_by", &Geometry::stretch_by)
@@ -13,6 +13,18 @@
 
 namespace viz3 {
 
+std::vector<std::tuple<float, float, float>> Geometry::vertex_coords() const
+{
+    // Plain tuples are converted to Python without wrapping a Point object
+    // for each vertex, which matters for geometries with many vertexes
+    std::vector<std::tuple<float, float, float>> coords;
+    coords.reserve(m_vertexes.size());
+    for (const auto& vertex : m_vertexes)
+        coords.emplace_back(vertex.x, vertex.y, vertex.z);
+
+    return coords;
+}
+
 void Geometry::scale_by(float factor)
 {
     m_pos *= factor;
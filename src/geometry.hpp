@@ -42,6 +42,7 @@ struct Geometry {
     }
 
     std::vector<Point> vertexes() const { return m_vertexes; }
+    std::vector<std::tuple<float, float, float>> vertex_coords() const;
     std::vector<Face> triangles() const { return m_triangles; }
 
     Bounds bounds() const { return m_bounds; }
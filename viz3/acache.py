@@ -30,9 +30,14 @@ def convert_json_datetime_strings(json_dict: dict) -> dict:
     Converts ISO-8601 strings within a dictionary to datetime objects.
     """
     for key, value in json_dict.items():
+        # This is called for every JSON object read, so skip values that
+        # cannot be datetimes rather than raising and catching an exception
+        # for every one of them
+        if not isinstance(value, str):
+            continue
         try:
             json_dict[key] = datetime.datetime.fromisoformat(value)
-        except (ValueError, AttributeError, TypeError):
+        except ValueError:
             pass
     return json_dict
 
@@ -191,14 +196,18 @@ class NopCache(AbstractCache):
 
 
 class InMemoryCache(AbstractCache):
+    """
+    Stores a cache in memory. Unlike other caches, the query and identifier
+    can be any hashable object (e.g. a tuple), since nothing is serialized.
+    """
 
     def __init__(self):
         self._cache = collections.defaultdict(dict)
 
-    def retrieve(self, query: str, identifier: str):
+    def retrieve(self, query: typing.Hashable, identifier: typing.Hashable):
         return self._cache[identifier][query]
 
-    def store(self, query: str, identifier: str, data: typing.Any):
+    def store(self, query: typing.Hashable, identifier: typing.Hashable, data: typing.Any):
         self._cache[identifier][query] = data
 
 
@@ -8,7 +8,6 @@ LayoutEngine).
 
 from __future__ import annotations
 import dataclasses
-import re
 import typing
 
 from . import core
@@ -105,16 +104,18 @@ class AttributeBinding:
 @dataclasses.dataclass
 class BindingFilter:
     data_path: core.Path
-    selector: typing.Set[typing.Optional[str]]
+    selector: typing.FrozenSet[typing.Optional[str]]
     is_negative: bool
     is_regex: bool
+    # The compiled selector if is_regex, see lang.FilterLanguage
+    compiled_selector: typing.Tuple[typing.Pattern, ...] = ()
 
     def does_match_null(self) -> bool:
         return None in self.selector
 
     def should_keep(self, instance) -> bool:
         if self.is_regex:
-            does_match = any(re.search(exp, instance) is not None for exp in self.selector)
+            does_match = any(pattern.search(instance) is not None for pattern in self.compiled_selector)
         else:
             does_match = instance in self.selector
 
@@ -219,19 +220,24 @@ class BindingTree(tree.Tree):
         Yields all data paths in this tree in the order defined by the
         bindings.
         """
-        if not self.is_root():
-            binding = self.binding()
-
-            yield binding.data_path()
-            for attr_binding in binding.attr_bindings():
-                yield from attr_binding.data_paths()
-
-            if binding.has_filter():
-                assert binding.filter()
-                yield binding.filter().data_path
-
-        for child_binding_node in self:
-            yield from child_binding_node.walk_data_paths()
+        # Walked depth-first with a stack, rather than recursively, so that
+        # each path is not yielded through a generator per level of the tree
+        binding_nodes = [self]
+        while binding_nodes:
+            binding_node = binding_nodes.pop()
+            if not binding_node.is_root():
+                binding = binding_node.binding()
+
+                yield binding.data_path()
+                for attr_binding in binding.attr_bindings():
+                    yield from attr_binding.data_paths()
+
+                if binding.has_filter():
+                    assert binding.filter()
+                    yield binding.filter().data_path
+
+            # Reversed, so that the children are popped in order
+            binding_nodes.extend(reversed(list(binding_node)))
 
     def _construct_child(self, binding: Binding) -> BindingTree:
         child_node = BindingTree(binding, self)
@@ -18,6 +18,13 @@ from .. import acache
 from matplotlib import pyplot as plt
 import networkx
 
+try:
+    # libyaml's C emitter is much faster on large generated configs; only
+    # available when PyYAML was built against libyaml
+    from yaml import CSafeDumper as _YamlSafeDumper
+except ImportError:
+    from yaml import SafeDumper as _YamlSafeDumper
+
 
 def mangle_name(datasource_name, node_name) -> str:
     assert node_name != ""
@@ -241,6 +248,9 @@ class DataNode(abc.ABC):
     Defines a node in the data graph. This class is meant to be subclasses by
     custom data sources.
     """
+    # Graphs can have many nodes; subclasses without __slots__ still get a
+    # __dict__ as usual
+    __slots__ = ("_datasource_name", "_name", "_mangled_name", "_typeof")
 
     def __init__(self, datasource_name: str, name: str, typeof: typing.Type):
         self._datasource_name = datasource_name
@@ -358,6 +368,7 @@ NodeValues = typing.Dict['DataNode', typing.Any]
 
 
 class Result(abc.ABC):
+    __slots__ = ("_node",)
 
     def __init__(self, node):
         self._node = node
@@ -436,6 +447,9 @@ class ResultGraph:
     def __init__(self, data_graph: DataGraph):
         self._data_graph = data_graph
         self._network = networkx.DiGraph()
+        # Resolved paths to their result in the network; result() is called
+        # for each attribute (and filter) of each value when visualizing
+        self._results: typing.Dict[core.Path, Result] = {}
 
     @classmethod
     def from_paths(cls, data_graph: DataGraph, paths_iter: typing.Iterable[core.Path]) -> ResultGraph:
@@ -484,6 +498,7 @@ class ResultGraph:
                 self._network.add_edge((prev_resolved_path, prev_result), (curr_resolved_path, curr_result))
             else:
                 self._network.add_node((curr_resolved_path, curr_result))
+            self._results.setdefault(curr_resolved_path, curr_result)
 
             prev_result = curr_result
             prev_data_node = curr_data_node
@@ -495,12 +510,10 @@ class ResultGraph:
         """
         resolved_path = self._data_graph.resolve_shortest_paths_within(path)
 
-        # FIXME: We have a graph, why not use it?
-        for path_and_result in self._network.nodes:
-            node_path, node_result = path_and_result
-            if node_path == resolved_path:
-                return node_result
-        raise ValueError("No such result for path: " + str(path))
+        result = self._results.get(resolved_path)
+        if result is None:
+            raise ValueError("No such result for path: " + str(path))
+        return result
 
 
 ModuleMap = typing.Dict[str, types.ModuleType]
@@ -681,4 +694,5 @@ def _process_joins(joins_data: typing.List[dict], module_map: ModuleMap, graph:
 
 
 def dump_yaml(datasource_name: str, datasource_data: dict):
-    return yaml.safe_dump({"datasources": {datasource_name: datasource_data}}, sort_keys=False)
+    return yaml.dump({"datasources": {datasource_name: datasource_data}}, Dumper=_YamlSafeDumper,
+                     default_flow_style=False, sort_keys=False)
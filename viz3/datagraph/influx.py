@@ -13,9 +13,12 @@ in combining data nodes into singular queries when compared to SQLite (also a
 table-like data source) since InfluxDB v1 doesn't have JOINs.
 """
 import abc
-import collections
+import concurrent.futures
 import datetime
+import functools
 import logging
+import operator
+import sys
 import typing
 
 from .. import datagraph
@@ -57,6 +60,21 @@ def rfc3339_to_datetime(rf3339: str) -> datetime.datetime:
     return datetime.datetime.fromisoformat(rf3339.rstrip("Z"))
 
 
+def _tuple_getter(keys: typing.Iterable[str]) -> typing.Callable[[dict], tuple]:
+    """
+    Returns a function that returns a tuple of the values in the given
+    dictionary for the given keys (in iteration order), like
+    operator.itemgetter(), except a tuple is always returned.
+    """
+    keys = tuple(keys)
+    if len(keys) == 0:
+        return lambda _: ()
+    if len(keys) == 1:
+        key = keys[0]
+        return lambda d: (d[key],)
+    return operator.itemgetter(*keys)
+
+
 string_type_map = {
     "int": int,
     "str": str,
@@ -67,6 +85,10 @@ string_type_map = {
     "bytes": bytes,
 }
 
+# Inverse of string_type_map; the first string listed for a type wins (e.g.
+# str -> "str", not "string")
+_type_string_map = {typeof: string for string, typeof in reversed(string_type_map.items())}
+
 
 # Valid InfluxDB types encoded in Python
 InfluxDBTypes = typing.Union[int,str,float,bool,datetime.datetime,bytes]
@@ -83,6 +105,9 @@ class InfluxDBQuerier:
     Executes queries on an InfluxDB database.
     """
 
+    # Max number of concurrent queries made (see extract_measurements_from_influxdb)
+    max_workers = 16
+
     def __init__(self, host: str, database: str, username: str, password: str,
                  proxy: typing.Optional[str] = None,
                  cache: typing.Optional[acache.AbstractCache] = None):
@@ -101,7 +126,8 @@ class InfluxDBQuerier:
             username=self._username,
             password=self._password,
             database=self._database,
-            proxies=proxy_dict
+            proxies=proxy_dict,
+            pool_size=self.max_workers
         )
         self._cache: acache.AbstractCache = acache.NopCache()
         if cache is not None:
@@ -190,14 +216,27 @@ class InfluxDBQuerier:
         #              'values': [['1970-01-01T00:00:00Z',
         #                          30.0,
         #                          'Tesla A100']]}, ...]
+        # Most series share the same timestamp (see FIXME below), so only
+        # parse each distinct time string once
+        parsed_times: typing.Dict[str, datetime.datetime] = {}
         results = []
         for raw_result_dict in raw_result:
             result_dict = dict(zip(raw_result_dict["columns"], raw_result_dict["values"][0]))
-            result_dict.update(raw_result_dict.get("tags", {}))
+            series_tags = raw_result_dict.get("tags")
+            if series_tags:
+                # Tag values repeat across series (e.g. the same host for
+                # every cpu); interning makes equal tag values the same object
+                # which is cheaper to store and compare when rows are combined
+                # by tag values (see _combine_distinct_rows)
+                result_dict.update((tag, sys.intern(tag_value)) for tag, tag_value in series_tags.items())
             # FIXME? If a time range is not specified, then the time column
             #        will be zero  aka 1970 epoch if last() or aggregation
             #        functions are used in the query.
-            result_dict["time"] = rfc3339_to_datetime(result_dict["time"])
+            time_string = result_dict["time"]
+            parsed_time = parsed_times.get(time_string)
+            if parsed_time is None:
+                parsed_time = parsed_times[time_string] = rfc3339_to_datetime(time_string)
+            result_dict["time"] = parsed_time
             results.append(result_dict)
 
         return results
@@ -228,7 +267,7 @@ class InfluxDBQuerier:
                 tag_value = rest[i + 1:j]
                 j += 1
 
-            tag_values[tag] = tag_value
+            tag_values[tag] = sys.intern(tag_value)  # See run_query()
             rest = rest[j:]
 
         return measurement_name, tag_values
@@ -295,6 +334,10 @@ class InfluxDBMeasurement:
         self._measurement_name = measurement_name
         self._tags = tags
         self._field_types = field_types
+        # Measurements are not modified after construction, so these are
+        # computed once rather than on every call
+        self._fields = frozenset(self._field_types)
+        self._columns = frozenset(self._tags) | self._fields
 
     def measurement_name(self):
         return self._measurement_name
@@ -302,14 +345,14 @@ class InfluxDBMeasurement:
     def tags(self) -> typing.Set[str]:
         return self._tags
 
-    def fields(self) -> typing.Set[str]:
-        return set(self._field_types)
+    def fields(self) -> typing.FrozenSet[str]:
+        return self._fields
 
     def field_types(self) -> typing.Dict[str, typing.Type]:
         return self._field_types.copy()
 
-    def columns(self) -> typing.Set[str]:
-        return self.tags() | self.fields()
+    def columns(self) -> typing.FrozenSet[str]:
+        return self._columns
 
     @staticmethod
     def combine(*measurements: 'InfluxDBMeasurement'):
@@ -414,9 +457,16 @@ class InfluxDBConstraint:
     """
 
     def __init__(self, fields: typing.Dict[str, InfluxDBTypes], tags: typing.Dict[str, str]):
+        self._field_types = {field: type(val) for field, val in fields.items()}
         self._fields = fields
         self._tags = tags
 
+    @staticmethod
+    def _value_matches(expected_value: typing.Any, value: InfluxDBTypeOrList) -> bool:
+        if isinstance(value, list):
+            return expected_value in value
+        return expected_value == value
+
     def tags(self) -> typing.Set[str]:
         return set(self._tags)
 
@@ -424,7 +474,14 @@ class InfluxDBConstraint:
         return set(self._fields)
 
     def field_types(self) -> typing.Dict[str, typing.Type]:
-        return {field: type(val) for field, val in self._fields.items()}
+        return self._field_types.copy()
+
+    def is_empty(self) -> bool:
+        """
+        Returns whether there are no tags or fields to constrain against (i.e.
+        every row matches).
+        """
+        return len(self._fields) == 0 and len(self._tags) == 0
 
     def column_matches(self, key: str, value: InfluxDBTypeOrList) -> bool:
         """
@@ -432,29 +489,16 @@ class InfluxDBConstraint:
         i.e. if all keys within a row return True for this function, then the row
              can be kept.
         """
-        if len(self._fields) == 0 and len(self._tags) == 0:
+        if self.is_empty():
             return True
 
         if key not in self._fields and key not in self._tags:
             return True
 
-        for tag, tag_value in self._tags.items():
-            if tag != key:
-                continue
-            if isinstance(value, list):
-                if tag_value in value:
-                    return True
-            elif tag_value == value:
-                return True
-
-        for field, field_value in self._fields.items():
-            if field != key:
-                continue
-            if isinstance(value, list):
-                if field_value in value:
-                    return True
-            elif field_value == value:
-                return True
+        if key in self._tags and self._value_matches(self._tags[key], value):
+            return True
+        if key in self._fields and self._value_matches(self._fields[key], value):
+            return True
         return False
 
     def __repr__(self):
@@ -473,7 +517,8 @@ class InfluxDBDataGraph(datagraph.DataGraph):
         super().__init__()
         self._querier = querier
         self._datasource_name = datasource_name
-        self._tag_nodes = collections.defaultdict(list)
+        # tag -> InfluxDBSharedTagNode; see construct_influxdb_tag()
+        self._shared_tag_nodes: typing.Dict[str, InfluxDBSharedTagNode] = {}
 
     @classmethod
     def graph_from_measurements(cls, querier: InfluxDBQuerier, datasource_name: str,
@@ -500,7 +545,10 @@ class InfluxDBDataGraph(datagraph.DataGraph):
         return graph
 
     def find_shared_tag(self, tag: str):
-        return self.find(self._datasource_name, tag)
+        try:
+            return self._shared_tag_nodes[tag]
+        except KeyError:
+            return self.find(self._datasource_name, tag)
 
     def find_by_column(self, measurement_name: str, column_name: str):
         return self.find(self._datasource_name, mangle_measurement_column_name(measurement_name, column_name))
@@ -539,10 +587,10 @@ class InfluxDBDataGraph(datagraph.DataGraph):
         # the same node (e.g. .host.cpu_usage, .host.mem_usage instead of
         # .mem_host.mem_usage and .cpu_host.cpu_usage); this is important
         # for the relative queries used when mapping queries to viz3 layouts
-        try:
-            shared_tag_node = self.find_shared_tag(tag)
-        except ValueError:
+        shared_tag_node = self._shared_tag_nodes.get(tag)
+        if shared_tag_node is None:
             shared_tag_node = self._create_influxdb_shared_tag(tag)
+            self._shared_tag_nodes[tag] = shared_tag_node
 
         self.add_edge_node(shared_tag_node, tag_node)
         return tag_node
@@ -565,6 +613,10 @@ class InfluxDBNode(datagraph.DataNode, abc.ABC):
     query object that is used for retrieving values.
     """
 
+    # Either "tag" or "field"; used to dispatch on the node kind when
+    # building constraints without walking isinstance() chains
+    _CONSTRAINT_KIND: typing.Optional[str] = None
+
     def __init__(self, querier: InfluxDBQuerier, datasource_name: str,
                  name: str, type: typing.Type = str):
         super().__init__(datasource_name, name, type)
@@ -590,6 +642,8 @@ class InfluxDBSharedTagNode(InfluxDBNode):
     Used for selecting tag values across multiple measurements.
     """
 
+    _CONSTRAINT_KIND = "tag"
+
     def __init__(self, querier: InfluxDBQuerier, datasource_name: str, tag: str):
         super().__init__(querier, datasource_name, tag, str)
 
@@ -640,6 +694,8 @@ class InfluxDBMeasurementTagNode(InfluxDBMeasurementNode):
     Stores an InfluxDB tag belonging to a specific measurement within a node.
     """
 
+    _CONSTRAINT_KIND = "tag"
+
     def __init__(self, querier: InfluxDBQuerier, datasource_name: str,
                  measurement_name: str, tag: str):
         super().__init__(querier, datasource_name, measurement_name, tag, str)
@@ -663,6 +719,8 @@ class InfluxDBMeasurementFieldNode(InfluxDBMeasurementNode):
     Stores an InfluxDB measurement field within a node.
     """
 
+    _CONSTRAINT_KIND = "field"
+
     def __init__(self, querier: InfluxDBQuerier, datasource_name: str,
                  measurement_name: str, field: str, typeof: typing.Type):
         super().__init__(querier, datasource_name, measurement_name, field, typeof)
@@ -714,10 +772,11 @@ class InfluxDBResult(datagraph.Result, abc.ABC):
             if not self.is_same_datasource(ancestor_node):
                 continue
 
-            if isinstance(ancestor_node, InfluxDBMeasurementFieldNode):
+            # See InfluxDBNode._CONSTRAINT_KIND
+            kind = ancestor_node._CONSTRAINT_KIND
+            if kind == "field":
                 field_constraints[ancestor_node.field()] = expected_value
-            elif (isinstance(ancestor_node, InfluxDBMeasurementTagNode)
-                  or isinstance(ancestor_node, InfluxDBSharedTagNode)):
+            elif kind == "tag":
                 tag_constraints[ancestor_node.tag()] = expected_value
             else:
                 assert False
@@ -734,6 +793,17 @@ class InfluxDBResult(datagraph.Result, abc.ABC):
         than a singular value. All of the values within a list are returned
         when the row matches the constraints.
         """
+        # Common case: nothing to constrain against, so skip checking every
+        # column of every row
+        if constraints.is_empty():
+            for row_dict in values:
+                value = row_dict[column]
+                if isinstance(value, list):  # See _combine_distinct_rows
+                    yield from value
+                else:
+                    yield value
+            return
+
         for row_dict in values:
             if all(constraints.column_matches(k, v) for k, v in row_dict.items()):
                 value = row_dict[column]
@@ -757,6 +827,9 @@ class InfluxDBMeasurementResult(InfluxDBResult):
     def __init__(self, node: InfluxDBMeasurementNode, measurement: InfluxDBMeasurement):
         super().__init__(node)
         self._measurement = measurement
+        # Our cache is in-memory, so we can key on the measurement directly
+        # rather than building a string
+        self._cache_id = (self._measurement.measurement_name(), self._measurement.columns())
 
     def join(self, other_node: datagraph.DataNode) -> datagraph.Result:
         node = self.node()
@@ -808,32 +881,59 @@ class InfluxDBMeasurementResult(InfluxDBResult):
              with the same host returned by the database need to be combined. In
              that case, the "cpu" and "cpu_usage" columns of the rows will have
              multiple values
+
+        NOTE: This cannot be pushed into InfluxDB with a GROUP BY on just the
+              requested tags; combined with last(), InfluxDB returns only
+              the last value of each group rather than the union of values
+              (e.g. the usage of a single CPU per host). See as_query().
         """
         distinct_tags = measurement.tags()
+        all_tag_values = list(map(_tuple_getter(distinct_tags), rows))
+
+        # Common case: the tags already uniquely identify each row (e.g. the
+        # tags requested are all the tags in the database measurement), so
+        # there is nothing to combine. The rows are not modified by callers,
+        # so there is no need to copy them.
+        if len(set(all_tag_values)) == len(all_tag_values):
+            return rows
+
+        # First pass: gather the distinct values of each column for every group
+        # of rows with the same tag values (i.e. column-wise, rather than
+        # merging each row into the previous row per column). The distinct
+        # values are stored as dictionary keys, which act as an insertion
+        # ordered set; all InfluxDB types are hashable.
+        grouped_columns: typing.Dict[tuple, typing.Dict[str, typing.Dict[InfluxDBTypes, None]]] = {}
+        for tag_values, row in zip(all_tag_values, rows):
+            # Note: .setdefault() would allocate a throwaway dict per call
+            columns = grouped_columns.get(tag_values)
+            if columns is None:
+                grouped_columns[tag_values] = {key: {value: None} for key, value in row.items()}
+                continue
 
-        # Each row will either contain a value, or a list of values if there
-        # are multiple different values. This works since there is no list
-        # type in InfluxDB.
-        combined_rows = collections.defaultdict(dict)
-        for row in rows:
-            tag_values = tuple(row[tag] for tag in distinct_tags)
-            prev_row_dict = combined_rows[tag_values]
             for key, value in row.items():
-                if key not in prev_row_dict:
-                    prev_row_dict[key] = value
-                    continue
-
-                if prev_row_dict[key] == value:
-                    continue
-                elif not isinstance(prev_row_dict[key], list):
-                    prev_value = prev_row_dict[key]
-                    prev_row_dict[key] = [prev_value, value]
-                elif value not in prev_row_dict[key]:
-                    prev_row_dict[key].append(value)
+                distinct_values = columns.get(key)
+                if distinct_values is None:
+                    columns[key] = {value: None}
+                else:
+                    distinct_values[value] = None
 
+        # Second pass: each row will either contain a value, or a list of
+        # values if there are multiple different values. This works since
+        # there is no list type in InfluxDB.
+        #
         # Note: Dictionaries are ordered by insertion; we use this to return
         #       values in the same order as given
-        return list(combined_rows.values())
+        combined_rows = []
+        for columns in grouped_columns.values():
+            combined_row = {}
+            for key, distinct_values in columns.items():
+                if len(distinct_values) == 1:
+                    combined_row[key] = next(iter(distinct_values))
+                else:
+                    combined_row[key] = list(distinct_values)
+            combined_rows.append(combined_row)
+
+        return combined_rows
 
     def _values(self, constraints: InfluxDBConstraint) -> CombinedRows:
         node = self.node()
@@ -860,15 +960,11 @@ class InfluxDBMeasurementResult(InfluxDBResult):
 
         constraints = self.constraints_from_node_values(ancestor_node_values)
         column_name = node.column_name()
-        cache_id = mangle_measurement_column_name(
-            self._measurement.measurement_name(),
-            "_".join(self._measurement.columns())
-        )
 
         yield from self.filter_values(
             column_name,
             constraints,
-            self._cache.retrieve_or_update(column_name, cache_id, self._values, constraints)
+            self._cache.retrieve_or_update(column_name, self._cache_id, self._values, constraints)
         )
 
 
@@ -882,6 +978,7 @@ class InfluxDBSharedTagResult(InfluxDBResult):
     def __init__(self, node: InfluxDBSharedTagNode, tags: typing.Set[str]):
         super().__init__(node)
         self._tags = tags
+        self._cache_id = frozenset(self._tags)  # See InfluxDBMeasurementResult
 
     def join(self, other_node: datagraph.DataNode) -> datagraph.Result:
         node = self.node()
@@ -907,12 +1004,11 @@ class InfluxDBSharedTagResult(InfluxDBResult):
 
         constraints = self.constraints_from_node_values(ancestor_node_values)
         tag = node.tag()
-        cache_id = "_".join(sorted(self._tags))
 
         yield from self.filter_values(
             tag,
             constraints,
-            self._cache.retrieve_or_update(tag, cache_id, self._values, constraints)
+            self._cache.retrieve_or_update(tag, self._cache_id, self._values, constraints)
         )
 
 
@@ -936,24 +1032,23 @@ def extract_measurements_from_influxdb(querier: InfluxDBQuerier) -> typing.List[
     Returns a list of InfluxDB measurement objects for each measurement found
     in InfluxDB.
     """
-    measurements = []
-    for measurement_name in querier.measurement_names():
-        measurement = extract_measurement_from_influxdb(querier, measurement_name)
-        measurements.append(measurement)
-
-    return measurements
+    # Each measurement requires a couple of queries; since these are network
+    # bound, run them concurrently rather than one after another
+    with concurrent.futures.ThreadPoolExecutor(max_workers=querier.max_workers) as executor:
+        return list(executor.map(
+            lambda measurement_name: extract_measurement_from_influxdb(querier, measurement_name),
+            querier.measurement_names()
+        ))
 
 
 def type_to_yaml_type_string(typeof: typing.Type) -> str:
     """
     Returns a string form of the given type.
     """
-    for string, string_typeof in string_type_map.items():
-        if string_typeof == typeof:
-            return string
-    assert False
+    return _type_string_map[typeof]
 
 
+@functools.lru_cache
 def yaml_type_string_to_type(type_string: str) -> typing.Type:
     """
     Returns a type from the given string.
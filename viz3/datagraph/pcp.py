@@ -5,27 +5,33 @@ Defines a PCP-PMAPI data source according to datagraph.py.
 """
 
 from __future__ import annotations
-import copy
 from pydoc import locate
 import collections
 import dataclasses
+import functools
 import json
 import typing
+import urllib.parse
 
 import requests
 import yaml
 
+from .. import acache
 from .. import core
 from .. import datagraph
 
 
+_mangle_table = str.maketrans(".", "-")
+_demangle_table = str.maketrans("-", ".")
+
+
 def mangle_metric_name(metric: str) -> str:
     assert "-" not in metric
-    return metric.replace(".", "-")
+    return metric.translate(_mangle_table)
 
 
 def demangle_metric_name(mangled: str) -> str:
-    return ".".join(mangled.split("-"))
+    return mangled.translate(_demangle_table)
 
 
 @dataclasses.dataclass(frozen=True)
@@ -56,9 +62,25 @@ InstanceMap = typing.Dict[int, str]
 
 class PMProxyQuerier:
 
-    def __init__(self, target: str, proxy: typing.Optional[str] = None):
+    # Max number of connections kept open to pmproxy
+    max_connections = 16
+
+    def __init__(self, target: str, proxy: typing.Optional[str] = None,
+                 cache: typing.Optional[acache.AbstractCache] = None):
         self._target = target
         self._proxy = proxy
+        self._cache: acache.AbstractCache = acache.NopCache()
+        if cache is not None:
+            self._cache = cache
+        # Metadata (metric and indom descriptors) doesn't change during a run,
+        # so we always cache it in memory to avoid duplicate requests, regardless of the
+        # configured cache
+        self._metadata_cache = acache.InMemoryCache()
+        # Keeps connections to pmproxy alive between requests, rather than
+        # paying a TCP handshake per request
+        self._session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_maxsize=self.max_connections)
+        self._session.mount("http://", adapter)
 
     def target(self):
         return self._target
@@ -66,14 +88,35 @@ class PMProxyQuerier:
     def proxy(self):
         return self._proxy
 
-    def indom(self, indom_str) -> InDom:
-        resp = requests.get(
-            "http://{}/pmapi/indom".format(self._target),
-            params={"indom": indom_str},
+    def cache(self) -> acache.AbstractCache:
+        return self._cache
+
+    def _get_json(self, path: str, params: typing.Dict[str, str]) -> typing.Any:
+        resp = self._session.get(
+            "http://{}{}".format(self._target, path),
+            params=params,
             proxies=self._proxy
         )
+        return resp.json()
+
+    @staticmethod
+    def _cache_key(path: str, params: typing.Dict[str, str]) -> str:
+        return path + "?" + urllib.parse.urlencode(sorted(params.items()))
+
+    def _get_metadata_json(self, path: str, params: typing.Dict[str, str]) -> typing.Any:
+        """
+        Like _get_json(), but the response is cached in memory on the path and
+        params (i.e. only use this for responses that do not change during a
+        run). The configured cache is only read if pmproxy cannot be reached.
+        """
+        key = self._cache_key(path, params)
+        return self._metadata_cache.retrieve_or_update(
+            key, ".pmapi",
+            self._cache.fetch_and_update_or_fallback, key, ".pmapi", self._get_json, path, params
+        )
 
-        json_data = resp.json()
+    def indom(self, indom_str) -> InDom:
+        json_data = self._get_metadata_json("/pmapi/indom", {"indom": indom_str})
 
         # Here we try and pick a label, going with the cannoncial 'indom_name',
         # if it exists, then falling back to a terrible but usable alternative.
@@ -114,14 +157,8 @@ class PMProxyQuerier:
         if metric_names:
             params = {"names": ",".join(metric_names)}
 
-        resp = requests.get(
-            "http://{}/pmapi/metric".format(self._target),
-            params=params,
-            proxies=self._proxy
-        )
-
         metrics = []
-        metrics_data = resp.json()["metrics"]
+        metrics_data = self._get_metadata_json("/pmapi/metric", params)["metrics"]
         for metric_data in metrics_data:
             metric = Metric(metric_data["name"], metric_data.get("indom", None), type_from_typename(metric_data["type"]))
             metrics.append(metric)
@@ -129,14 +166,17 @@ class PMProxyQuerier:
         return metrics
 
     def indom_instances(self, indom_str: str) -> InstanceMap:
-        resp = requests.get(
-            "http://{}/pmapi/indom".format(self._target),
-            params={"indom": indom_str},
-            proxies=self._proxy
+        # Instances come and go (e.g. processes, mounts), so rather than using
+        # the metadata cache, only fall back to the last known instances if
+        # pmproxy cannot be reached
+        params = {"indom": indom_str}
+        json_data = self._cache.fetch_and_update_or_fallback(
+            self._cache_key("/pmapi/indom", params), ".pmapi_instances",
+            self._get_json, "/pmapi/indom", params
         )
 
         instance_map = {}
-        instance_dict_list = resp.json()["instances"]
+        instance_dict_list = json_data["instances"]
         for instance_dict in instance_dict_list:
             instance = instance_dict["instance"]
             instance_name = instance_dict["name"]
@@ -145,23 +185,21 @@ class PMProxyQuerier:
         return instance_map
 
     def metric_values(self, metric_name: str, instances: typing.Optional[InstanceMap] = None) -> InstanceValues:
-        resp = requests.get(
-            "http://{}/pmapi/fetch".format(self._target),
-            params={"name": metric_name},
-            proxies=self._proxy
-        )
-
-        instance_values = {}
-        data = resp.json()
+        # Not cached; values change between fetches
+        data = self._get_json("/pmapi/fetch", {"name": metric_name})
         # 0 -> only one name requested
         instance_dict_list = data["values"][0]["instances"]
-        for instance_dict in instance_dict_list:
-            instance = instance_dict["instance"]
-            if not instances or instance in instances:
-                value = instance_dict["value"]
-                instance_values[instance] = value
+        if not instances:
+            return {
+                instance_dict["instance"]: instance_dict["value"]
+                for instance_dict in instance_dict_list
+            }
 
-        return instance_values
+        return {
+            instance_dict["instance"]: instance_dict["value"]
+            for instance_dict in instance_dict_list
+            if instance_dict["instance"] in instances
+        }
 
 
 class PCPDataGraph(datagraph.DataGraph):
@@ -260,6 +298,7 @@ class InDomResult(datagraph.Result):
     def __init__(self, indom_node: InDomNode, instances: InstanceMap):
         super().__init__(indom_node)
         self._instances = instances
+        self._instance_keys = tuple(instances.keys())
 
     def join(self, other_node: datagraph.DataNode) -> datagraph.Result:
         node = self.node()
@@ -269,7 +308,8 @@ class InDomResult(datagraph.Result):
 
         if isinstance(other_node, MetricNode) and other_node.datasource_name() == node.datasource_name():
             per_instance_values = node.querier().metric_values(other_node.metric_name(), instances=self._instances)
-            return MetricResult(other_node, per_instance_values, copy.deepcopy(self._instances))
+            # Instances map ints to strs (immutable), so a shallow copy suffices
+            return MetricResult(other_node, per_instance_values, dict(self._instances))
 
         return other_node.result()
 
@@ -283,7 +323,7 @@ class InDomResult(datagraph.Result):
         if node in ancestor_node_values:
             yield ancestor_node_values[node]
         else:
-            yield from self._instances.keys()
+            yield from self._instance_keys
 
 
 class MetricResult(datagraph.Result):
@@ -310,14 +350,21 @@ class MetricResult(datagraph.Result):
         node = self.node()
         assert isinstance(node, MetricNode)
 
-        for instance, value in self._per_instance_values.items():
-            for ancestor_node, expected_value in ancestor_node_values.items():
-                if (isinstance(ancestor_node, InDomNode)
-                        and ancestor_node.is_indom_for_metric(node)
-                        and instance != expected_value):
-                    break
-            else:
-                yield value
+        # The instances we are constrained to do not change per instance, so
+        # find them once up front
+        expected_instances = {
+            expected_value
+            for ancestor_node, expected_value in ancestor_node_values.items()
+            if isinstance(ancestor_node, InDomNode) and ancestor_node.is_indom_for_metric(node)
+        }
+        if not expected_instances:
+            yield from self._per_instance_values.values()
+        elif len(expected_instances) == 1:
+            # Different instances are never equal to each other, so more
+            # than one expected instance matches nothing
+            expected_instance = next(iter(expected_instances))
+            if expected_instance in self._per_instance_values:
+                yield self._per_instance_values[expected_instance]
 
 
 def create_graph_from_metrics(querier: PMProxyQuerier,
@@ -349,18 +396,28 @@ def mangle_yaml_identifier(metric_name: str):
     return metric_name.replace(".", "_")
 
 
-def type_from_typename(typename: str) -> typing.Type:
+# PCP typenames, plus the Python typenames written by type_to_typename()
+_typename_conversions = {
     # curl -s 'http://localhost:44322/pmapi/metric' | jq | grep \"type | sort | uniq | awk -F\" '{ print $4 }'
-    hardcoded_conversions = {
-        "32": int,
-        "64": int,
-        "double": float,
-        "string": str,
-        "u32": int,
-        "u64": int,
-    }
-    if typename in hardcoded_conversions:
-        return hardcoded_conversions[typename]
+    "32": int,
+    "64": int,
+    "double": float,
+    "string": str,
+    "u32": int,
+    "u64": int,
+    # type_to_typename()
+    "int": int,
+    "float": float,
+    "str": str,
+    "bool": bool,
+    "bytes": bytes,
+}
+
+
+@functools.lru_cache
+def type_from_typename(typename: str) -> typing.Type:
+    if typename in _typename_conversions:
+        return _typename_conversions[typename]
 
     # fallback to locate(), which returns a type from a fully qualified type
     # name (e.g. '__main__.Object' with 'class Object' -> Object): 'int' -> int
@@ -433,7 +490,7 @@ def from_yaml(datasource_name, datasource_data, cache):
 
     target = datasource_data["target"]
     proxy_or_none = datasource_data.get("proxy", None)
-    querier = PMProxyQuerier(target, proxy=proxy_or_none)
+    querier = PMProxyQuerier(target, proxy=proxy_or_none, cache=cache)
 
     indom_strs_to_indom_map = {}
     for indom_name, indom_float in datasource_data["indoms"].items():
@@ -450,8 +507,8 @@ def from_yaml(datasource_name, datasource_data, cache):
             indom_or_none = str(metric_data["indom"])
             assert indom_or_none in indom_strs_to_indom_map
 
+        typeof = type_from_typename(metric_data["type"])
         for metric_name in metric_data["metrics"]:
-            typeof = type_from_typename(metric_data["type"])
             metric = Metric(metric_name, indom_or_none, typeof)
             metrics.append(metric)
 
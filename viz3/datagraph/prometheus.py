@@ -4,6 +4,7 @@
 Defines a Prometheus data source according to datagraph.py.
 """
 import abc
+import builtins
 import collections
 import copy
 import dataclasses
@@ -11,8 +12,11 @@ import datetime
 import enum
 import functools
 import itertools
+import json
 import logging
 import re
+import threading
+import time
 import typing
 
 import more_itertools
@@ -32,6 +36,13 @@ class PrometheusQuerier:
     A wrapper around Prometheus' HTTP API.
     """
 
+    # Max number of connections kept open to Prometheus
+    max_connections = 16
+    # (connect, read) seconds to wait on Prometheus before a request fails;
+    # without it a hung server blocks forever rather than failing over to the
+    # cache (see acache.class_fallback_cache)
+    request_timeout_secs = (5, 60)
+
     def __init__(self, prometheus_target: str, proxy: typing.Optional[str] = None,
                  cache: typing.Optional[acache.AbstractCache] = None):
         self._target = prometheus_target
@@ -43,6 +54,20 @@ class PrometheusQuerier:
         if proxy is not None:
             self._proxy = {"http": proxy}
 
+        self._base_url = "http://" + self._target
+        # See https://prometheus.io/docs/prometheus/latest/querying/api/
+        self._endpoints = {
+            endpoint: "{}/api/v1/{}".format(self._base_url, endpoint)
+            for endpoint in ("query", "query_range", "series", "metadata")
+        }
+        # Keeps connections to Prometheus alive between requests, rather than
+        # paying a TCP handshake per request
+        self._session = requests.Session()
+        self._session.mount("http://", requests.adapters.HTTPAdapter(pool_maxsize=self.max_connections))
+        # API path -> [requests, failed requests, total seconds]; see request_stats()
+        self._request_stats: typing.Dict[str, typing.List] = collections.defaultdict(lambda: [0, 0, 0.0])
+        self._request_stats_lock = threading.Lock()
+
     def cache(self) -> acache.AbstractCache:
         return self._cache
 
@@ -52,6 +77,48 @@ class PrometheusQuerier:
     def proxy(self):
         return self._proxy
 
+    def request_stats(self) -> typing.Dict[str, typing.Dict[str, typing.Any]]:
+        """
+        Returns a dictionary of the API paths requested by this querier to the
+        number of requests made, how many of those failed, and the total and
+        mean seconds spent on them. Useful for tuning caching and max_connections.
+        """
+        with self._request_stats_lock:
+            return {
+                path: {
+                    "requests": num_requests,
+                    "failures": num_failures,
+                    "total_secs": total_secs,
+                    "mean_secs": total_secs / num_requests,
+                }
+                for path, (num_requests, num_failures, total_secs) in self._request_stats.items()
+            }
+
+    def _get_data(self, url: str, params: typing.Optional[dict] = None) -> typing.Any:
+        """
+        Returns the "data" of the JSON response from the given API URL.
+        """
+        path = url[len(self._base_url):]
+        failed = True
+        start_secs = time.perf_counter()
+        try:
+            resp = self._session.get(url, params=params, proxies=self._proxy,
+                                     timeout=self.request_timeout_secs)
+            # Parse the raw bytes directly; resp.json() first decodes the body
+            # into a str (guessing the encoding), which is an extra copy of
+            # what can be a large response
+            data = json.loads(resp.content)["data"]
+            failed = False
+            return data
+        finally:
+            elapsed_secs = time.perf_counter() - start_secs
+            logger.debug("%s %s in %.3fs", path, "failed" if failed else "succeeded", elapsed_secs)
+            with self._request_stats_lock:
+                stats = self._request_stats[path]
+                stats[0] += 1
+                stats[1] += failed
+                stats[2] += elapsed_secs
+
     @acache.class_fallback_cache
     def query_range_and_group_by_label(self, query, id_label, start_dt, end_dt, step_secs=60*5) \
             -> typing.Dict[datetime.datetime, typing.Dict[str, float]]:
@@ -81,23 +148,22 @@ class PrometheusQuerier:
         logger.debug("executing query_range %s (%s-%s/%s)", query, start_dt, end_dt, step_secs)
 
         # See https://prometheus.io/docs/prometheus/latest/querying/api/
-        resp = requests.get(
-            "http://{}/api/v1/query_range".format(self._target),
-            params={
-                "query": query,
-                "start": start_dt.strftime("%s"),
-                "end": end_dt.strftime("%s"),
-                "step": step_secs,
-            },
-            proxies=self._proxy
-        )
-        results =  resp.json()["data"]["result"]
+        results = self._get_data(self._endpoints["query_range"], params={
+            "query": query,
+            "start": int(start_dt.timestamp()),
+            "end": int(end_dt.timestamp()),
+            "step": step_secs,
+        })["result"]
 
         time_id_value_map = collections.defaultdict(dict)
+        # This loop runs for every (series, timestamp) pair, so avoid
+        # attribute and global lookups within it
+        id_values_at = time_id_value_map.__getitem__
+        to_float = float
         for result in results:
             id_label_value = result["metric"][id_label]
             for ts, value in result["values"]:
-                time_id_value_map[ts][id_label_value] = float(value)
+                id_values_at(ts)[id_label_value] = to_float(value)
 
         return time_id_value_map
 
@@ -111,12 +177,6 @@ class PrometheusQuerier:
         logger.debug("executing query %s", query)
 
         # See https://prometheus.io/docs/prometheus/latest/querying/api/
-        resp = requests.get(
-            "http://{}/api/v1/query".format(self._target),
-            params={"query": query},
-            proxies=self._proxy
-        )
-
         # {
         #   "status": "success",
         #   "data": {
@@ -135,7 +195,7 @@ class PrometheusQuerier:
         #         ]
         #       },
         #       ...
-        results = resp.json()["data"]["result"]
+        results = self._get_data(self._endpoints["query"], params={"query": query})["result"]
 
         to_return = []
         for result in results:
@@ -167,17 +227,11 @@ class PrometheusQuerier:
         logger.debug("executing series %s (%s-%s)", metrics, start_dt, end_dt)
 
         # See https://prometheus.io/docs/prometheus/latest/querying/api/
-        resp = requests.get(
-            "http://{}/api/v1/series".format(self._target),
-            params={
-                "match[]": list(metrics),
-                "start": start_dt.strftime("%s"),
-                "end": end_dt.strftime("%s"),
-            },
-            proxies=self._proxy
-        )
-
-        series = resp.json()["data"]
+        series = self._get_data(self._endpoints["series"], params={
+            "match[]": metrics if isinstance(metrics, list) else list(metrics),
+            "start": int(start_dt.timestamp()),
+            "end": int(end_dt.timestamp()),
+        })
 
         series_labels = []
         for label_dict in series:
@@ -198,11 +252,7 @@ class PrometheusQuerier:
         logger.debug("executing metadata")
 
         # See https://prometheus.io/docs/prometheus/latest/querying/api/#querying-metric-metadata
-        resp = requests.get(
-            "http://{}/api/v1/metadata".format(self._target),
-            proxies=self._proxy
-        )
-        return resp.json()["data"]
+        return self._get_data(self._endpoints["metadata"])
 
     @acache.class_fallback_cache
     def label_values(self, label_name):
@@ -211,11 +261,7 @@ class PrometheusQuerier:
         """
         logger.debug("executing label_values %s", label_name)
 
-        resp = requests.get(
-            "http://{}/api/v1/label/{}/values".format(self._target, label_name),
-            proxies=self._proxy
-        )
-        return list(resp.json()["data"])
+        return list(self._get_data("{}/api/v1/label/{}/values".format(self._base_url, label_name)))
 
 
 class PrometheusDataGraph(datagraph.DataGraph):
@@ -224,8 +270,25 @@ class PrometheusDataGraph(datagraph.DataGraph):
         super().__init__()
         self._querier = querier
         self._datasource_name = datasource_name
+        # label name -> label node, for the labels constructed by this graph;
+        # avoids find() walking every node in the graph when building it
+        self._label_index: typing.Dict[str, PrometheusLabel] = {}
+
+    def _index_label(self, label_node: 'PrometheusLabel'):
+        # setdefault -> like find(), the first node added with a name wins
+        self._label_index.setdefault(label_node.name(), label_node)
+
+    def has_indexed_label(self, label_name: str) -> bool:
+        """
+        Returns whether a label with the given name was constructed by this
+        graph.
+        """
+        return label_name in self._label_index
 
     def find_by_label_name(self, label_name: str):
+        label_node = self._label_index.get(label_name)
+        if label_node is not None:
+            return label_node
         return self.find(self._datasource_name, label_name)
 
     def _create_prometheus_label(self, label_name: str):
@@ -238,6 +301,7 @@ class PrometheusDataGraph(datagraph.DataGraph):
     def construct_prometheus_label(self, label_name: str, from_label: typing.Optional['PrometheusLabel'] = None):
         label_node = self._create_prometheus_label(label_name)
         self.add_node(label_node, from_label)
+        self._index_label(label_node)
         return label_node
 
     def _create_prometheus_derived_label(self, derivation: 'PrometheusLabelDerivation'):
@@ -256,6 +320,7 @@ class PrometheusDataGraph(datagraph.DataGraph):
         target_node = self.find_by_label_name(derivation.target_label_name)
         self.add_edge_node(target_node, new_derived_node)
         self.add_node(new_derived_node, from_label)
+        self._index_label(new_derived_node)
 
         if derivation.parent_label_name:
             parent_label_node = self.find_by_label_name(derivation.parent_label_name)
@@ -273,9 +338,15 @@ class PrometheusDataGraph(datagraph.DataGraph):
 
             label_nodes[label_name] = aliased_label_node
 
-        for label_name, label_node in label_nodes.items():
-            for other_label_node in [node for name, node in label_nodes.items() if name != label_name]:
-                self.add_node_next_to(label_node, other_label_node)
+        # permutations -> add_node_next_to() only gives the first node the
+        #                 edges of the second, so both orders are needed
+        for label_node, other_label_node in itertools.permutations(label_nodes.values(), 2):
+            self.add_node_next_to(label_node, other_label_node)
+
+        # > 1 -> only labels paired above end up in the graph
+        if len(label_nodes) > 1:
+            for label_node in label_nodes.values():
+                self._index_label(label_node)
 
     def _create_prometheus_metric(self, metric_name: str):
         return PrometheusMetric(
@@ -329,11 +400,20 @@ class PrometheusNode(datagraph.DataNode, abc.ABC):
     def __init__(self, querier: PrometheusQuerier, datasource_name: str, name: str):
         super().__init__(datasource_name, name, str)
         self._querier = querier
+        self._label_matches: typing.Optional[typing.Tuple[str, ...]] = None
 
     def canonical_label_name(self) -> str:
         raise NotImplementedError()
 
     def label_matches(self) -> typing.Tuple[str, ...]:
+        # Nodes do not change once constructed, so only format the matches
+        # once; this is done lazily since subclasses may not have finished
+        # initializing themselves (e.g. canonical_label_name()) in __init__
+        if self._label_matches is None:
+            self._label_matches = self._make_label_matches()
+        return self._label_matches
+
+    def _make_label_matches(self) -> typing.Tuple[str, ...]:
         raise NotImplementedError()
 
     def querier(self):
@@ -357,7 +437,7 @@ class PrometheusLabel(PrometheusNode):
     def canonical_label_name(self):
         return self.label_name()
 
-    def label_matches(self) -> typing.Tuple[str, ...]:
+    def _make_label_matches(self) -> typing.Tuple[str, ...]:
         # This strange regex is because Prometheus does not allow queries
         # against it where all of the labels have empty matchers. e.g.
         # {instance=~".*"} or {instance=~"^.*$", label=~"^.*$"}
@@ -415,25 +495,39 @@ class PrometheusDerivedLabel(PrometheusLabel):
         self._target_label_name = target_label_name
         self._derivation_funcs = derivation_funcs
         self._default_or_none = default_or_none
+        # Label values repeat heavily (across values and across queries), so
+        # only run the derivation funcs once per distinct label value
+        self._derived_label_values: typing.Dict[str, typing.Optional[str]] = {}
 
     def canonical_label_name(self):
         return self._target_label_name
 
     def apply_derivation(self, to_label_value: str) -> typing.Optional[str]:
-        new_value = to_label_value
-        for derivation_func in self._derivation_funcs:
-            try:
+        try:
+            new_value = self._derived_label_values[to_label_value]
+        except KeyError:
+            new_value = self._apply_derivation(to_label_value)
+            self._derived_label_values[to_label_value] = new_value
+
+        if new_value is None or isinstance(new_value, str):  # immutable
+            return new_value
+        # Non-str defaults are shared by every cached value; hand out copies
+        return copy.deepcopy(new_value)
+
+    def _apply_derivation(self, to_label_value: str) -> typing.Optional[str]:
+        # One try around the whole chain, rather than one per derivation func;
+        # the first func to fail ends the chain either way
+        try:
+            new_value = to_label_value
+            for derivation_func in self._derivation_funcs:
                 new_value = derivation_func(new_value)
-            except Exception:
-                # if derivations throw errors, they are indicating
-                # that a derivation could not be performed so we should
-                # indicate that to the caller if there is not a default
-                if self._default_or_none is None:
-                    return None
-
-                return copy.deepcopy(self._default_or_none)
-
-        return new_value
+            return new_value
+        except Exception:
+            # if derivations throw errors, they are indicating
+            # that a derivation could not be performed so we should
+            # indicate that to the caller if there is not a default
+            # (apply_derivation() copies non-str defaults)
+            return self._default_or_none
 
     def same_value(self, first_value, second_value) -> bool:
         derived_value = self.apply_derivation(first_value)
@@ -463,7 +557,7 @@ class PrometheusMetric(PrometheusNode):
     def canonical_label_name(self):
         return self.metric_name()
 
-    def label_matches(self) -> typing.Tuple[str, ...]:
+    def _make_label_matches(self) -> typing.Tuple[str, ...]:
         return (
             '__name__="{}"'.format(self.metric_name()),
         )
@@ -509,8 +603,8 @@ class PrometheusEnumMetric(PrometheusMetric):
     def canonical_label_name(self):
         return self.enumerated_label_name()
 
-    def label_matches(self) -> typing.Tuple[str, ...]:
-        return super().label_matches() + (
+    def _make_label_matches(self) -> typing.Tuple[str, ...]:
+        return super()._make_label_matches() + (
             '{}="{}"'.format(self.enumerated_label_name(), self.fixed_label_value()),
         )
 
@@ -537,7 +631,11 @@ class PrometheusResult(datagraph.Result, abc.ABC):
                  prev_result: typing.Optional['PrometheusResult'] = None):
         super().__init__(node)
         self._prev_result = prev_result
-        self._cached_values = None
+        self._cached_values: typing.Optional[typing.Tuple[LabelValues, ...]] = None
+        # Results are not modified after construction, so the query is only
+        # built once; see as_query()
+        self._cached_joined_label_matches: typing.Optional[typing.Tuple[str, ...]] = None
+        self._cached_query: typing.Optional[str] = None
 
     def join(self, other_node: datagraph.DataNode) -> datagraph.Result:
         node = self.node()
@@ -568,38 +666,59 @@ class PrometheusResult(datagraph.Result, abc.ABC):
 
         return node_values
 
-    def _joined_label_matches(self) -> typing.Iterable[str]:
-        if self._prev_result:
-            yield from self._prev_result._joined_label_matches()
+    def _joined_label_matches(self) -> typing.Tuple[str, ...]:
+        if self._cached_joined_label_matches is None:
+            prev_label_matches: typing.Tuple[str, ...] = ()
+            if self._prev_result:
+                prev_label_matches = self._prev_result._joined_label_matches()
 
-        node = self.node()
-        assert isinstance(node, PrometheusNode)
-        yield from node.label_matches()
+            node = self.node()
+            assert isinstance(node, PrometheusNode)
+            self._cached_joined_label_matches = prev_label_matches + tuple(node.label_matches())
+
+        return self._cached_joined_label_matches
 
     def as_query(self):
-        # set -> deduplicate when joined labels are derived
-        # ordered -> make order consistent (easier for grepping logs)
-        return "{{{}}}".format(", ".join(sorted(set(self._joined_label_matches()))))
+        if self._cached_query is None:
+            # set -> deduplicate when joined labels are derived
+            # ordered -> make order consistent (easier for grepping logs)
+            self._cached_query = "{{{}}}".format(", ".join(sorted(set(self._joined_label_matches()))))
+
+        return self._cached_query
 
     @abc.abstractmethod
     def _raw_values(self) -> typing.Iterable[LabelValues]:
         raise NotImplementedError()
 
-    def raw_values(self) -> typing.List[LabelValues]:
-        if not self._cached_values:
-            # list -> if iterable keep around
-            self._cached_values = list(self._raw_values())
+    def raw_values(self) -> typing.Sequence[LabelValues]:
+        # is None -> an empty result is still a result; don't requery it
+        if self._cached_values is None:
+            # tuple -> if iterable keep around; immutable so that it can be
+            #          returned without copying
+            self._cached_values = tuple(self._raw_values())
 
-        return self._cached_values.copy()
+        return self._cached_values
 
     def raw_filtered_values(self, ancestor_node_values: datagraph.NodeValues) \
             -> typing.Iterator[LabelValues]:
-        comparable_label_values = self._comparable_node_values(ancestor_node_values)
+        # Work out how to compare each label once, rather than per row; most
+        # labels use plain equality, so avoid a method call for those
+        comparisons = []
+        for (label, label_name), expected_value in self._comparable_node_values(ancestor_node_values).items():
+            same_value = None
+            if type(label).same_value is not datagraph.DataNode.same_value:
+                same_value = label.same_value
+            comparisons.append((label_name, expected_value, same_value))
 
         for label_dict, value in self.raw_values():
-            for label_and_name, expected_value in comparable_label_values.items():
-                label, label_name = label_and_name
-                if label_name in label_dict and not label.same_value(label_dict[label_name], expected_value):
+            for label_name, expected_value, same_value in comparisons:
+                label_value = label_dict.get(label_name)
+                if label_value is None:  # label values are always strings
+                    continue
+                if same_value is None:
+                    if label_value != expected_value:
+                        break
+                elif not same_value(label_value, expected_value):
                     break
             else:
                 yield label_dict, value
@@ -626,8 +745,7 @@ class PrometheusLabelResult(PrometheusResult):
 
         # The HTTP /label/<label>/values API works for only one label;
         # more efficient
-        label_matches = list(self._joined_label_matches())
-        if len(label_matches) <= 1:
+        if len(self._joined_label_matches()) <= 1:
             for label_value in node.querier().label_values(node.canonical_label_name()):
                 yield {node.canonical_label_name(): label_value}, label_value
 
@@ -650,22 +768,18 @@ class PrometheusDerivedLabelResult(PrometheusLabelResult):
         node = self.node()
         assert isinstance(node, PrometheusDerivedLabel)
 
-        derived_values = []
+        # Combine values that are the same, regardless of input order (dict
+        # keys are unique); the _values() we get have no order with respect to
+        # the derivation, so combining values next to each other wouldn't work
+        derived_values = {}
         for raw_value in super().duplicated_values(ancestor_node_values):
             maybe_value = node.apply_derivation(raw_value)
             if maybe_value is not None:  # derivation may not work out
-                derived_values.append(maybe_value)
-
-        # Combine values that are the same, regardless of input order; We
-        # could try and combine similar values that are next to each other
-        # without sorting, but the problem is that the _values() we get have
-        # no order with respect to the derivation, so combining values next to
-        # each other wouldn't work (or at least isn't guaranteed to work)
+                derived_values[maybe_value] = None
 
-        # groupby returns an iterable of tuples, where the first item is the key
-        # and the second item is the group of values
-        for value, _ in itertools.groupby(sorted(derived_values)):
-            yield value
+        # Derived values have always been returned in sorted order; only sort
+        # the distinct values though
+        yield from sorted(derived_values)
 
 
 class PrometheusMetricResult(PrometheusResult):
@@ -698,12 +812,31 @@ class PrometheusMetricRelationship:
     label_value_enums: typing.Dict[str, typing.Dict[str, str]]
 
     def has_same_labels(self, other: 'PrometheusMetricRelationship'):
-        return (
-            self.primary_label_names == other.primary_label_names
-            and self.label_name_aliases == other.label_name_aliases
-            and self.value_label_names == other.value_label_names
-            and self.label_value_enums == other.label_value_enums
-        )
+        return self.labels_signature() == other.labels_signature()
+
+    def labels_signature(self) -> typing.Hashable:
+        """
+        Returns a hashable value that is equal for two relationships exactly
+        when they have the same labels (and associated enums and the like).
+        """
+        # Relationships are frozen, so this is only built once, on demand
+        # (relationships from from_yaml() are never compared);
+        # object.__setattr__ gets around the frozen dataclass' __setattr__
+        signature = self.__dict__.get("_labels_signature")
+        if signature is None:
+            signature = (
+                # label name order matters; alias groups and enums are sets
+                tuple(self.primary_label_names),
+                frozenset(tuple(alias_group) for alias_group in self.label_name_aliases),
+                tuple(self.value_label_names),
+                frozenset(
+                    (label_name, frozenset(values_to_names.items()))
+                    for label_name, values_to_names in self.label_value_enums.items()
+                ),
+            )
+            object.__setattr__(self, "_labels_signature", signature)
+
+        return signature
 
 
 def create_graph_from_relationships(querier: PrometheusQuerier,
@@ -730,9 +863,13 @@ def create_graph_from_relationships(querier: PrometheusQuerier,
         # Create alias label nodes initially to allow for derived labels to refer
         # to them, but delay fully setting up edges until after the metric is
         # constructed, so that aliases all point to metrics if needed.
-        alias_label_names = more_itertools.flatten(metric_relationship.label_name_aliases)
-        for alias_label_name in more_itertools.unique_everseen(alias_label_names):
-            construct_label(alias_label_name, None)
+        #
+        # Labels already in the graph (e.g. aliases shared between metrics) are
+        # skipped; constructing them again would not change the graph
+        for label_name_alias_group in metric_relationship.label_name_aliases:
+            for alias_label_name in label_name_alias_group:
+                if not graph.has_indexed_label(alias_label_name):
+                    construct_label(alias_label_name, None)
 
         assert prev_primary_label_node is not None
         for value_label_name in metric_relationship.value_label_names:
@@ -771,19 +908,34 @@ def format_yaml(querier: PrometheusQuerier,
     # are the same
     counter = 1
     grouped_relationships = collections.defaultdict(list)
+    # labels signature -> group prefix; avoids comparing against every group
+    group_prefixes = {}
     for metric_relationship in metric_relationships:
-        name = metric_relationship.name
-        prefix = name.rsplit("_", maxsplit=1)[0] if "_" in name else name
-        for group_prefix, relationships in grouped_relationships.copy().items():
-            if relationships[0].has_same_labels(metric_relationship):
-                grouped_relationships[group_prefix].append(metric_relationship)
-                break
-        else:
-            if prefix in grouped_relationships:  # name collision
-                prefix += str(counter)
+        signature = metric_relationship.labels_signature()
+        group_prefix = group_prefixes.get(signature)
+        if group_prefix is None:
+            name = metric_relationship.name
+            group_prefix = name.rsplit("_", maxsplit=1)[0] if "_" in name else name
+            if group_prefix in grouped_relationships:  # name collision
+                group_prefix += str(counter)
                 counter += 1
 
-            grouped_relationships[prefix].append(metric_relationship)
+            group_prefixes[signature] = group_prefix
+
+        grouped_relationships[group_prefix].append(metric_relationship)
+
+    groups = {}
+    for prefix, relationships in grouped_relationships.items():
+        # Relationships in a group have the same labels, so any one of them
+        # can describe the group's labels
+        representative = relationships[0]
+        groups[prefix] = {
+            "metrics": [m.name for m in relationships],
+            "alias_labels": [list(alias_group) for alias_group in representative.label_name_aliases],
+            "primary_labels": list(representative.primary_label_names),
+            "value_labels": list(representative.value_label_names),
+            "label_value_enums": representative.label_value_enums
+        }
 
     # See from_yaml for the format here
     datasource_data = {
@@ -794,16 +946,7 @@ def format_yaml(querier: PrometheusQuerier,
             category: list(refinement_labels)
             for category, refinement_labels in label_categories.items()
         },
-        "groups": {
-            prefix: {
-                "metrics": [m.name for m in metric_relationships],
-                "alias_labels": [list(alias_group) for alias_group in metric_relationships[0].label_name_aliases],
-                "primary_labels": list(metric_relationships[0].primary_label_names),
-                "value_labels": list(metric_relationships[0].value_label_names),
-                "label_value_enums": metric_relationships[0].label_value_enums
-            }
-            for prefix, metric_relationships in grouped_relationships.items()
-        }
+        "groups": groups,
     }
     return datagraph.dump_yaml("prometheus", datasource_data)
 
@@ -813,13 +956,39 @@ def node_name_from_yaml_identifier(yaml_identifier: str) -> str:
     return yaml_identifier
 
 
-def _match_or_empty(pattern: str, string: str):
-    match_or_none = re.search(pattern, string)
+def _match_or_empty(pattern: typing.Pattern, string: str):
+    match_or_none = pattern.search(string)
     if match_or_none is None:
-        raise ValueError("Unable to match {} against pattern '{}'".format(string, pattern))
+        raise ValueError("Unable to match {} against pattern '{}'".format(string, pattern.pattern))
     return match_or_none.group(1)
 
 
+@functools.lru_cache
+def _derivation_func_from_expression(expression: str) -> DerivationFunc:
+    """
+    Returns the derivation function the given Python expression evaluates to.
+
+    The common case of naming a builtin (e.g. "int" or "str.lower") is looked
+    up directly, rather than compiling and evaluating the expression; anything
+    else (e.g. a lambda) is eval()'d.
+    """
+    name, *attr_names = expression.strip().split(".")
+    func = getattr(builtins, name, None)
+    for attr_name in attr_names:
+        if func is None or not attr_name.isidentifier():
+            func = None
+            break
+        func = getattr(func, attr_name, None)
+
+    if func is not None and callable(func):
+        return func
+
+    try:
+        return eval(expression)
+    except Exception as err:
+        raise ValueError("Could not evaluate expression '{}': {}".format(expression, err))
+
+
 def _derivation_from_yaml(derived_labels_data: typing.List[typing.Dict[str, str]]) \
         -> typing.List[PrometheusLabelDerivation]:
     """
@@ -878,7 +1047,14 @@ def _derivation_from_yaml(derived_labels_data: typing.List[typing.Dict[str, str]
                 # this results in last derivation_data value within this loop being
                 # provided to the function when it is finally called.
                 # functools.partial() fixes this for us.
-                derive_funcs.append(functools.partial(_match_or_empty, derivation_data))
+                #
+                # The regex is compiled here, once, rather than being looked up
+                # in re's cache for every label value derived
+                try:
+                    pattern = re.compile(derivation_data)
+                except re.error as err:
+                    raise ValueError("Could not compile regex '{}': {}".format(derivation_data, err))
+                derive_funcs.append(functools.partial(_match_or_empty, pattern))
 
             elif derivation_type == "parent":
                 parent_label_name = derivation_data
@@ -886,11 +1062,7 @@ def _derivation_from_yaml(derived_labels_data: typing.List[typing.Dict[str, str]
             elif derivation_type == "func" or derivation_type == "funcs":
                 uneval_data_list = [derivation_data] if derivation_type == "func" else derivation_data
                 for uneval_data in uneval_data_list:
-                    try:
-                        derive_funcs.append(eval(uneval_data))
-                    except Exception as err:
-                        raise ValueError("Could not evaluate expression '{}': {}"
-                                         .format(uneval_data, err))
+                    derive_funcs.append(_derivation_func_from_expression(uneval_data))
             elif derivation_type == "default":
                 default_or_none = derivation_data
             else:
@@ -945,17 +1117,24 @@ def from_yaml(datasource_name: str,
     for metric_group_name, metric_data in datasource_data["groups"].items():
         assert len(metric_data["metrics"]) > 0
 
+        # These are the same for every metric in the group
+        primary_label_names = metric_data["primary_labels"]
+        alias_labels = metric_data.get("alias_labels", {})
+        value_label_names = list(metric_data.get("value_labels", {}))
+        label_value_enums = metric_data.get("label_value_enums", {})
         for metric_name in metric_data["metrics"]:
             relationship = PrometheusMetricRelationship(
                 metric_name,
-                metric_data["primary_labels"],
-                metric_data.get("alias_labels", {}),
+                primary_label_names,
+                alias_labels,
+                # Only filter (keeping the label order) when a metric is
+                # itself listed as a value label; otherwise share the list
                 [
                     value_label_name
-                    for value_label_name in metric_data.get("value_labels", {})
+                    for value_label_name in value_label_names
                     if value_label_name != metric_name
-                ],
-                metric_data.get("label_value_enums", {}),
+                ] if metric_name in value_label_names else value_label_names,
+                label_value_enums,
             )
             relationships.append(relationship)
 
@@ -5,9 +5,9 @@ Defines a Sqlite3 data source according to datagraph.py.
 """
 import collections
 import dataclasses
-import functools
 import logging
 import sqlite3
+import threading
 import typing
 
 from .. import acache
@@ -56,15 +56,21 @@ class Sqlite3Querier:
 
     def __init__(self, filepath: str):
         self._filepath = filepath
+        # Opened on the first query and reused for the rest, rather than
+        # opening (and setting up) the database file for every query
+        self._conn: typing.Optional[sqlite3.Connection] = None
+        # check_same_thread=False -> the connection may be used from other
+        # threads, so queries are serialized with this lock instead
+        self._conn_lock = threading.Lock()
 
-    def query(self, statement: str):
-        conn = sqlite3.connect(self._filepath)
-        cursor = conn.cursor()
-        cursor.execute(statement)
-        results = cursor.fetchall()
-        cursor.close()
-        conn.commit()
-        return results
+    def _connection(self) -> sqlite3.Connection:
+        if self._conn is None:
+            self._conn = sqlite3.connect(self._filepath, check_same_thread=False)
+        return self._conn
+
+    def query(self, statement: str, params: typing.Sequence[typing.Any] = ()):
+        with self._conn_lock:
+            return self._connection().execute(statement, params).fetchall()
 
 
 class Sqlite3DataGraph(datagraph.DataGraph):
@@ -72,6 +78,10 @@ class Sqlite3DataGraph(datagraph.DataGraph):
     def __init__(self, querier: Sqlite3Querier, datasource_name: str):
         self._querier = querier
         self._datasource_name = datasource_name
+        # (table name, column name) -> column node, for the columns
+        # constructed by this graph; avoids find() walking every node in the
+        # graph for every foreign key
+        self._column_index: typing.Dict[typing.Tuple[str, str], Sqlite3Column] = {}
         super().__init__()
 
     def _create_sqlite3_column(self, key: Key, table: Sqlite3Table):
@@ -96,13 +106,19 @@ class Sqlite3DataGraph(datagraph.DataGraph):
             except ValueError:
                 assert False
 
+        # setdefault -> like find(), the first node added with a name wins
+        self._column_index.setdefault((table.table_name, key.name), column_node)
         return column_node
 
     def find_by_column(self, table_name: str, column_name: str):
+        column_node = self._column_index.get((table_name, column_name))
+        if column_node is not None:
+            return column_node
         return self.find(self._datasource_name, mangle_table_and_column_names(table_name, column_name))
 
 
 class Sqlite3Column(datagraph.DataNode):
+    __slots__ = ("_querier", "_table", "_column_name")
 
     def __init__(self, querier: Sqlite3Querier, datasource_name: str, column_name: str, table: Sqlite3Table):
         name = mangle_table_and_column_names(table.table_name, column_name)
@@ -131,36 +147,55 @@ class Sqlite3Column(datagraph.DataNode):
 
 
 class Sqlite3Result(datagraph.Result):
+    __slots__ = ("_prev_result", "_cache", "_join_plan", "_join_sql", "_constraining_table_names", "_statements")
 
     def __init__(self, column: Sqlite3Column, prev_result: typing.Optional['Sqlite3Result'] = None):
         super().__init__(column)
         self._prev_result = prev_result
-        self._cache = acache.InMemoryCache()
-
-    def _foreign_keys_in_chain(self, references_keys: typing.Optional[typing.List[Key]] = None) \
-            -> typing.Iterable[Key]:
+        # Results joined from one another (i.e. those of the same result graph
+        # walk) share their cache, so that the same query made from different
+        # branches of the walk is only run once
+        self._cache = prev_result._cache if prev_result is not None else acache.InMemoryCache()
+        # The chain of results never changes, so neither do the joins needed
+        self._join_plan = self._foreign_table_accesses_in_chain_impl()
+        self._join_sql = self._join_clauses()
+        # Tables whose columns can constrain our values
+        self._constraining_table_names = frozenset(self._join_plan) | {column.table_name()}
+        # (column id, constrained column ids) -> SELECT statement
+        self._statements: typing.Dict[typing.Tuple[str, typing.Tuple[str, ...]], str] = {}
+
+    def _foreign_keys_in_chain(self) -> typing.Iterable[Key]:
         node = self.node()
         assert isinstance(node, Sqlite3Column)
 
-        if not references_keys:
-            references_keys = node.table().foreign_keys()
-
-        assert references_keys is not None
-        for reference_key in references_keys:
-            if reference_key.foreign_identifier() == node.identifier():
-                references_keys.remove(reference_key)
-                yield reference_key
+        # Each of our foreign keys is matched (at most once) against the
+        # closest result in the chain with the column it references
+        unmatched_keys = node.table().foreign_keys()
+        result: typing.Optional[Sqlite3Result] = self
+        while result is not None and unmatched_keys:
+            result_node = result.node()
+            assert isinstance(result_node, Sqlite3Column)
+            identifier = result_node.identifier()
+
+            still_unmatched_keys = []
+            for reference_key in unmatched_keys:
+                if reference_key.foreign_identifier() == identifier:
+                    yield reference_key
+                else:
+                    still_unmatched_keys.append(reference_key)
 
-        if self._prev_result:
-            yield from self._prev_result._foreign_keys_in_chain(references_keys)
+            unmatched_keys = still_unmatched_keys
+            result = result._prev_result
 
-    @functools.lru_cache
-    def _foreign_table_accesses_in_chain(self) -> typing.Dict[str, typing.List[Key]]:
+    def _foreign_table_accesses_in_chain_impl(self) -> typing.Dict[str, typing.List[Key]]:
         foreign_keys_by_table = collections.defaultdict(list)
         for foreign_key in self._foreign_keys_in_chain():
             foreign_keys_by_table[foreign_key.foreign_table_name].append(foreign_key)
 
-        return foreign_keys_by_table
+        return dict(foreign_keys_by_table)
+
+    def _foreign_table_accesses_in_chain(self) -> typing.Dict[str, typing.List[Key]]:
+        return self._join_plan
 
     def join(self, other_node: datagraph.DataNode) -> datagraph.Result:
         node = self.node()
@@ -174,50 +209,71 @@ class Sqlite3Result(datagraph.Result):
         node = self.node()
         assert isinstance(node, Sqlite3Column)
 
-        foreign_table_names = set(self._foreign_table_accesses_in_chain())
-
         column_constraints = {}
         for ancestor_node, expected_value in ancestor_node_values.items():
             if (not isinstance(ancestor_node, Sqlite3Column)
                     or ancestor_node.datasource_name() != node.datasource_name()):
                 continue
 
-            ancestor_table_name = ancestor_node.table_name()
-            if ancestor_table_name == node.table_name() or ancestor_table_name in foreign_table_names:
+            if ancestor_node.table_name() in self._constraining_table_names:
                 column_constraints[ancestor_node.identifier()] = expected_value
 
         return column_constraints
 
-    def _query_values(self, *column_names: str) -> typing.List[typing.Dict[str, typing.Any]]:
+    def _join_clauses(self) -> str:
         node = self.node()
         assert isinstance(node, Sqlite3Column)
         table_name = node.table_name()
 
-        join = ""
-        for foreign_table_name, foreign_keys in self._foreign_table_accesses_in_chain().items():
-            join_on_clauses = []
-            for foreign_key in foreign_keys:
-                join_on_clauses.append("{}.{} = {}.{}".format(
-                    table_name,
-                    foreign_key.name,
-                    foreign_key.foreign_table_name,
-                    foreign_key.foreign_name
-                ))
+        # Built once per result (see __init__), as a single join of all the
+        # clauses rather than by repeated string concatenation
+        return "".join(
+            " JOIN {} ON {}".format(foreign_table_name, " AND ".join(
+                "{}.{} = {}.{}".format(table_name, foreign_key.name,
+                                       foreign_key.foreign_table_name, foreign_key.foreign_name)
+                for foreign_key in foreign_keys
+            ))
+            for foreign_table_name, foreign_keys in self._foreign_table_accesses_in_chain().items()
+        )
 
-            join += " JOIN {} ON {}".format(foreign_table_name, " AND ".join(join_on_clauses))
+    def _statement(self, column_id: str, constrained_column_ids: typing.Tuple[str, ...]) -> str:
+        # Statements only differ by the columns selected and constrained (the
+        # constrained values are bound parameters), so only build them once;
+        # the same string also lets sqlite3 reuse its prepared statement
+        statement_key = (column_id, constrained_column_ids)
+        statement = self._statements.get(statement_key)
+        if statement is None:
+            node = self.node()
+            assert isinstance(node, Sqlite3Column)
+
+            # Have Sqlite only return the rows matching the constraints, rather
+            # than returning every row and filtering them here.
+            #
+            # IS -> like =, but also matches NULL against None
+            where = ""
+            if constrained_column_ids:
+                where = " WHERE " + " AND ".join("{} IS ?".format(column) for column in constrained_column_ids)
+
+            statement = "SELECT DISTINCT {} FROM {}{}{} ORDER BY {}".format(
+                column_id, node.table_name(), self._join_sql, where, column_id
+            )
+            self._statements[statement_key] = statement
+
+        return statement
 
-        selector = ", ".join(column_names)
-        statement = "SELECT DISTINCT {} FROM {}{} ORDER BY {}".format(selector, table_name, join, selector)
-        logger.debug("executing %s", statement)
+    def _query_values(self, column_id: str, column_constraints: typing.Dict[str, typing.Any]) \
+            -> typing.List[typing.Any]:
+        node = self.node()
+        assert isinstance(node, Sqlite3Column)
 
-        values = []
-        for row_values in node.querier().query(statement):
-            values.append({c: v for c, v in zip(column_names, row_values)})
+        statement = self._statement(column_id, tuple(column_constraints))
+        params = tuple(column_constraints.values())
+        logger.debug("executing %s %s", statement, params)
 
-        return values
+        return [value for value, in node.querier().query(statement, params)]
 
     def values(self, ancestor_node_values: typing.Optional[datagraph.NodeValues] = None) \
-            -> typing.Dict[str, typing.Any]:
+            -> typing.Iterable[typing.Any]:
         if not ancestor_node_values:
             ancestor_node_values = {}
 
@@ -226,19 +282,14 @@ class Sqlite3Result(datagraph.Result):
         node = self.node()
         assert isinstance(node, Sqlite3Column)
         column_id = node.identifier()
-        other_column_ids = list(column_constraints.keys())
-        other_column_ids.append(column_id)
-        cache_id = "_".join(list(sorted(other_column_ids)))
-
-        for values in self._cache.retrieve_or_update(column_id, cache_id, self._query_values, *other_column_ids):
-            skipped_a_row = False
-            for key, value in values.items():
-                if key in column_constraints and column_constraints.get(key) != value:
-                    skipped_a_row = True
-                    break
+        # The constrained values are part of the query now, so they are part of
+        # what is cached too; frozenset -> order independent, without sorting
+        cache_id = frozenset(column_constraints.items())
 
-            if not skipped_a_row:
-                yield values[column_id]
+        # join SQL -> the cache is shared with results with other joins
+        cache_key = (column_id, self._join_sql)
+
+        yield from self._cache.retrieve_or_update(cache_key, cache_id, self._query_values, column_id, column_constraints)
 
 
 def create_graph_from_schema(querier: Sqlite3Querier,
@@ -343,17 +394,17 @@ def from_yaml(datasource_name, datasource_data, cache):
         for value_key_name in table_data.get("values", []):
             value_keys.append(Key(value_key_name, table_name, value_key_name))
 
+        # Names of the keys that a category can be a category of
+        subset_key_names_allowed = {key.name for key in primary_keys + value_keys}
         category_keys = collections.defaultdict(list)
         for category_key_name, subset_key_names in table_data.get("category_keys", {}).items():
-            assert all(key.name != category_key_name for key in primary_keys + value_keys)
+            assert category_key_name not in subset_key_names_allowed
             category_key = Key(name=category_key_name, foreign_table_name=table_name, foreign_name=category_key_name)
             for subset_key_name in subset_key_names:
-                for key in list(category_keys.keys()) + value_keys + primary_keys:
-                    if key.name == subset_key_name:
-                        category_keys[category_key].append(key.name)
-                        break
-                else:
-                    assert False
+                assert subset_key_name in subset_key_names_allowed
+                category_keys[category_key].append(subset_key_name)
+                # Categories can categorize (previous) categories too
+                subset_key_names_allowed.add(category_key_name)
 
         table = Sqlite3Table(
             table_name,
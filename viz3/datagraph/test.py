@@ -10,7 +10,6 @@ import typing
 
 import networkx
 import pandas
-import more_itertools
 
 from .. import datagraph
 
@@ -48,6 +47,7 @@ class TestDataGraph(datagraph.DataGraph):
 
 
 class TestNode(datagraph.DataNode):
+    __slots__ = ("_dataframe",)
 
     def __init__(self, dataframe: pandas.DataFrame, datasource_name: str, column_name: str):
         super().__init__(datasource_name, column_name, str)
@@ -64,6 +64,7 @@ class TestNode(datagraph.DataNode):
 
 
 class TestResult(datagraph.Result):
+    __slots__ = ("_dataframe",)
 
     def __init__(self, node: datagraph.DataNode, dataframe: pandas.DataFrame):
         super().__init__(node)
@@ -77,8 +78,23 @@ class TestResult(datagraph.Result):
             our_dataframe = node.dataframe()
             other_dataframe = other_node.dataframe()
 
-            joined_dataframe = pandas.concat([our_dataframe, other_dataframe], join="inner", keys=[other_node.column_name()])
-            #joined_dataframe = our_dataframe.join(other_dataframe, on=node.column_name())
+            if our_dataframe is other_dataframe:
+                # Nodes from the same graph share a single table, which is
+                # already "joined"
+                return TestResult(other_node, our_dataframe)
+
+            # Join rows on the columns the tables have in common (a hash join
+            # within pandas), or pair up every row if there are none
+            shared_column_names = [
+                column_name
+                for column_name in our_dataframe.columns
+                if column_name in other_dataframe.columns
+            ]
+            if shared_column_names:
+                joined_dataframe = our_dataframe.merge(other_dataframe, on=shared_column_names,
+                                                       how="inner", sort=False)
+            else:
+                joined_dataframe = our_dataframe.merge(other_dataframe, how="cross")
             return TestResult(other_node, joined_dataframe)
 
         assert False
@@ -104,12 +120,21 @@ class TestResult(datagraph.Result):
         node = self.node()
         assert isinstance(node, TestNode)
 
-        # FIXME: This selection is probably not efficent.
-        df = self._dataframe.copy()
+        # Combine the selections into one mask, rather than creating (and
+        # copying) a new dataframe for each one
+        # (arrays -> no need for pandas to align the masks by index)
+        df = self._dataframe
+        mask = None
         for ancestor_node, value in self.comparable_node_values(ancestor_node_values).items():
-            df = df[df[ancestor_node.column_name()] == value]
+            matches = (df[ancestor_node.column_name()] == value).to_numpy()
+            mask = matches if mask is None else mask & matches
 
-        yield from more_itertools.unique_everseen(df.loc[:, node.column_name()].values)
+        column = df[node.column_name()]
+        if mask is not None:
+            column = column[mask]
+
+        # unique() -> hashed, and keeps the order values are first seen in
+        yield from column.unique()
 
 
 def create_data_graph_from_dataframe(dataframe: pandas.DataFrame,
@@ -5,7 +5,8 @@ Defines a module that parses XML into a LayoutEngine.
 """
 
 from __future__ import annotations
-import inspect
+import dataclasses
+import functools
 import sys
 import typing
 
@@ -23,6 +24,32 @@ XMLNode = typing.Type[lxml.etree._ElementTree]
 XMLElement = typing.Type[lxml.etree.Element]
 
 
+@functools.lru_cache
+def _element_constructors() -> typing.Dict[str, type]:
+    """
+    Returns a dictionary of lowercase mangled element names (see
+    _lookup_element_constructor()) to their viz3 element constructors.
+    """
+    is_element_class = lambda m: isinstance(m, type) and (m.__name__.endswith("Element") or m.__name__.endswith("Layout"))
+
+    constructors = {}
+    # sorted(), like inspect.getmembers(), so which class wins does not depend
+    # on the order the module defines them in
+    members = sorted(vars(sys.modules["viz3.core"]).items())
+    classes = [(cls_name, cls) for cls_name, cls in members if is_element_class(cls)]
+    for cls_name, cls in classes:
+        element_name = cls_name
+        if element_name.endswith("Layout"):
+            element_name = element_name[:-len("Layout")]
+        if element_name.endswith("Element"):
+            element_name = element_name[:-len("Element")]
+
+        # setdefault -> the first class (by name) with the mangled name wins
+        constructors.setdefault(element_name.lower(), cls)
+
+    return constructors
+
+
 def _lookup_element_constructor(name: str) -> type:
     """
     Returns a Python viz3 element constructor for the given name. Name
@@ -36,33 +63,40 @@ def _lookup_element_constructor(name: str) -> type:
     >>> _lookup_element_constructor("Grid")
     GridLayoutElement
     """
-    is_element_class = lambda m: inspect.isclass(m) and (m.__name__.endswith("Element") or m.__name__.endswith("Layout"))
-
-    classes = inspect.getmembers(sys.modules["viz3.core"], is_element_class)
-    for cls_name, cls in classes:
-        element_name = cls_name
-        if element_name.endswith("Layout"):
-            element_name = element_name[:-len("Layout")]
-        if element_name.endswith("Element"):
-            element_name = element_name[:-len("Element")]
+    # This is called for every XML element, so avoid searching the core module
+    # for element classes each time
+    try:
+        return _element_constructors()[name.lower()]
+    except KeyError:
+        raise bindings.BindingError("Element constructor could not be found for {}".format(name))
 
-        if element_name.lower() == name.lower():
-            return cls
 
-    raise bindings.BindingError("Element constructor could not be found for {}".format(name))
+# Attributes that configure the binding of an element, rather than being
+# attributes of the element itself
+_BINDING_ATTRIBUTE_NAMES = frozenset({"name", "bind", "path", "filter"})
 
 
-def _pop_and_retrieve_attribute_bindings(element_path: core.Path,
-                                         attribute_dict: typing.Dict[str, str]) \
+def _retrieve_attribute_bindings(element_path: core.Path,
+                                 attributes: typing.Mapping[str, str]) \
         -> typing.List[bindings.AttributeBinding]:
     """
-    Given a dictionary of XML attributes, returns a list of attribute bindings.
+    Given a mapping of XML attributes, returns a list of attribute bindings
+    for those that are not binding attributes (e.g. bind="...").
     """
     attr_bindings = []
-    for attr, content in attribute_dict.copy().items():
+    for attr, content in attributes.items():
+        # path looks like an attribute binding if it has no slashes, so skip
+        # it along with the other binding attributes
+        if attr in _BINDING_ATTRIBUTE_NAMES:
+            continue
+
+        # Most attributes are plain values (e.g. color="red"), so avoid parsing
+        # (and raising for) those that cannot be a value language
+        if not lang.ValueLanguage.looks_like(content):
+            continue
+
         try:
             val_lang = lang.ValueLanguage.from_string(content, element_path)
-            attribute_dict.pop(attr)
             attr_bindings.append(bindings.AttributeBinding(val_lang, attr))
         except lang.LanguageSyntaxError:
             pass
@@ -70,31 +104,19 @@ def _pop_and_retrieve_attribute_bindings(element_path: core.Path,
     return attr_bindings
 
 
-def _try_pop_and_retrieve_filter(element_path: core.Path,
-                                 attribute_dict: typing.Dict[str, str]) \
+def _try_retrieve_filter(element_path: core.Path,
+                         filter_str_or_none: typing.Optional[str]) \
         -> typing.Optional[bindings.BindingFilter]:
     """
-    Given a dictionary of XML attributes, returns the filters to apply, or None
-    if there is no filter. See _looks_like_value_language for what is a value
-    language that gets returned as a binding.
+    Given the filter="..." attribute of an XML element, returns the filters to
+    apply, or None if there is no filter.
     """
-    filter_str_or_none = attribute_dict.pop("filter", None)
     if filter_str_or_none is None:
         return None
 
     val_lang = lang.FilterLanguage.from_string(filter_str_or_none, element_path)
-    return bindings.BindingFilter(val_lang.path(), val_lang.selector(), val_lang.is_negative(), val_lang.is_regex())
-
-
-def _unique_name_from_xml_element(xml_node: XMLElement) -> str:
-    """
-    Returns a unique name for the given XML node.
-    """
-    name = xml_node.tag
-    parent_node_or_none = xml_node.getparent()
-    if parent_node_or_none is not None:
-        name += str(parent_node_or_none.index(xml_node))
-    return name
+    return bindings.BindingFilter(val_lang.path(), val_lang.selector(), val_lang.is_negative(),
+                                  val_lang.is_regex(), val_lang.compiled_selector())
 
 
 def _create_element(tag: str, name: str, attributes: typing.Dict[str, typing.Any]):
@@ -106,100 +128,153 @@ def _create_element(tag: str, name: str, attributes: typing.Dict[str, typing.Any
                                     "name=\"{}\">: {}".format(tag, name, str(err)))
 
 
-def _create_layout_node_from_xml(layout_node: core.Node, xml_parent: XMLElement,
-                                 binding_tree: bindings.BindingTree,
-                                 ancestor_data_path: typing.Optional[core.Path] = None):
-    # copy since <include> elements insert children nodes
-    i_fixup = 0
-    for i, xml_child in enumerate(list(xml_parent)):
-        tag = xml_child.tag  # e.g. 'juxtapose' of <juxapose>
-        if not isinstance(tag, str):  # skip comments, and other XML weirdness
-            continue
+@dataclasses.dataclass
+class _XMLParent:
+    """
+    The layout and binding state of an XML element whose children are being
+    parsed.
+    """
+    layout_node: core.Node
+    binding_tree: bindings.BindingTree
+    ancestor_data_path: typing.Optional[core.Path]
+    # Number of unnamed children of the layout node seen so far, by tag. Shared
+    # with <include>s, whose children are created as the layout node's.
+    tag_counts: typing.Dict[str, int] = dataclasses.field(default_factory=dict)
 
-        attributes = dict(xml_child.attrib.items())  # .e.g <... name="foo"> -> {"name": "foo"}
-        name = attributes.pop("name", _unique_name_from_xml_element(xml_child))
-        # path looks like attribute binding, so pop now so func doesn't get confused
-
-        data_bind_text = attributes.pop("bind", None)
-        if data_bind_text is not None:
-            data_bind_lang = lang.BindLanguage.from_string(data_bind_text, ancestor_data_path)
-            data_bind_path = data_bind_lang.path()
-        else:
-            data_bind_lang = None
-            data_bind_path = ancestor_data_path if ancestor_data_path is not None else core.Path()
-
-        # Pop here, since _pop_and_retrieve_attribute_bindings might interpret the
-        # path as an attribute binding if the path has no slashes
-        include_path_or_none = attributes.pop("path", None)
-        limit = int(attributes["limit"]) if "limit" in attributes else None
-        binding_filter_or_none = _try_pop_and_retrieve_filter(data_bind_path, attributes)
-        attr_bindings = _pop_and_retrieve_attribute_bindings(data_bind_path, attributes)
-        if len(attr_bindings) > 0 and data_bind_lang is None:
-            # If someone does text="Usage: .usage bytes", but leaves out the
-            # bind="..." part, use the ancestor binding (since that is
-            # presumably what the attribute bindings are relative to)
-            data_bind_lang = lang.BindLanguage(data_bind_path)
-
-        if tag == "include":
-            if include_path_or_none is None:
-                raise ValueError("No 'path' attribute for include element!")
-
-            i_fixup += _insert_subxml_into_parent(include_path_or_none, i + i_fixup, xml_child)
-            _create_layout_node_from_xml(layout_node, xml_child, binding_tree, ancestor_data_path)
-            continue
 
-        element = _create_element(tag, name, attributes)
+def _unique_name(parent: _XMLParent, tag: str) -> str:
+    """
+    Returns a name for an unnamed element with the given tag that is unique
+    among the unnamed children of the parent's layout node, e.g. box0, box1.
+    """
+    count = parent.tag_counts.get(tag, 0)
+    parent.tag_counts[tag] = count + 1
+    return tag + str(count)
 
-        if data_bind_lang is not None:
-            layout_node_child = layout_node.construct_template(element)
-            layout_child_path = utils.LayoutPath(layout_node_child.path())
-            child_binding_tree = binding_tree.construct_subbinding(
-                layout_child_path,
-                data_bind_lang,
-                attr_bindings,
-                binding_filter_or_none,
-                limit,
-            )
-        else:
-            child_binding_tree = binding_tree
-            layout_node_child = layout_node.construct_child(element)
 
-        _create_layout_node_from_xml(layout_node_child, xml_child, child_binding_tree, data_bind_path)
-        i += 1
+def _create_layout_node_from_xml(parent: _XMLParent, xml_child: XMLElement) -> _XMLParent:
+    """
+    Creates the layout node (and binding) for the given XML element, a child
+    of the given parent. Returns the state of the element for parsing its
+    children.
+    """
+    tag = xml_child.tag  # e.g. 'juxtapose' of <juxapose>
+    layout_node = parent.layout_node
+    binding_tree = parent.binding_tree
+    ancestor_data_path = parent.ancestor_data_path
+
+    # Read (rather than copied into a dict and popped from), since the element
+    # only gets the attributes that are neither binding attributes nor bound
+    attributes = xml_child.attrib  # .e.g <... name="foo"> -> {"name": "foo"}
+    name = attributes.get("name")
+    if name is None:
+        name = _unique_name(parent, tag)
+
+    data_bind_text = attributes.get("bind")
+    if data_bind_text is not None:
+        data_bind_lang = lang.BindLanguage.from_string(data_bind_text, ancestor_data_path)
+        data_bind_path = data_bind_lang.path()
+    else:
+        data_bind_lang = None
+        data_bind_path = ancestor_data_path if ancestor_data_path is not None else core.Path()
+
+    limit = int(attributes["limit"]) if "limit" in attributes else None
+    binding_filter_or_none = _try_retrieve_filter(data_bind_path, attributes.get("filter"))
+    attr_bindings = _retrieve_attribute_bindings(data_bind_path, attributes)
+    if len(attr_bindings) > 0 and data_bind_lang is None:
+        # If someone does text="Usage: .usage bytes", but leaves out the
+        # bind="..." part, use the ancestor binding (since that is
+        # presumably what the attribute bindings are relative to)
+        data_bind_lang = lang.BindLanguage(data_bind_path)
+
+    if tag == "include":
+        # The included children are (as if they were) children of the
+        # <include>, and are created as children of the include's parent
+        return _XMLParent(layout_node, binding_tree, ancestor_data_path, parent.tag_counts)
+
+    bound_attr_names = {attr_binding.attribute() for attr_binding in attr_bindings}
+    element_attributes = {attr: content for attr, content in attributes.items()
+                          if attr not in _BINDING_ATTRIBUTE_NAMES and attr not in bound_attr_names}
+    element = _create_element(tag, name, element_attributes)
+
+    if data_bind_lang is not None:
+        layout_node_child = layout_node.construct_template(element)
+        layout_child_path = utils.LayoutPath(layout_node_child.path())
+        child_binding_tree = binding_tree.construct_subbinding(
+            layout_child_path,
+            data_bind_lang,
+            attr_bindings,
+            binding_filter_or_none,
+            limit,
+        )
+    else:
+        child_binding_tree = binding_tree
+        layout_node_child = layout_node.construct_child(element)
+
+    return _XMLParent(layout_node_child, child_binding_tree, data_bind_path)
+
+
+def _iterparse_xml(xml_filepath: str, root_tag: typing.Optional[str] = None) \
+        -> typing.Iterator[typing.Tuple[str, XMLElement]]:
+    """
+    Yields the ("start" and "end") parse events of the elements within the
+    root element of the given XML file, in document order. The children of
+    the XML files given by <include path="..."> elements are yielded right
+    after the start of the <include>.
 
+    Elements are freed once their end event has been handled, so the whole
+    document (or those it includes) is never in memory at once.
+    """
+    # We are using lxml here, since unlike xml.etree.ElementTree, iterating over
+    # subnodes can be done in document order!
+    depth = 0
+    for event, xml_node in lxml.etree.iterparse(xml_filepath, events=("start", "end")):
+        if event == "start":
+            depth += 1
+            if depth == 1:
+                if root_tag is not None and xml_node.tag != root_tag:
+                    raise bindings.BindingError("XML tree does not start with a <{}> tag!".format(root_tag))
+                continue
 
-def _insert_subxml_into_parent(sub_xml_filepath: str, i: int, parent_xml_node: XMLElement) -> XMLElement:
-    subxml_tree = lxml.etree.parse(sub_xml_filepath)
-    subxml_root = subxml_tree.getroot()
-    subxml_children = list(subxml_root)
-    for child_index, subxml_child in enumerate(subxml_children):
-        parent_xml_node.insert(i + child_index, subxml_child)
+            yield event, xml_node
 
-    assert all(new_xml_child.getparent() == parent_xml_node for new_xml_child in parent_xml_node)
-    return len(subxml_children)
+            if xml_node.tag == "include":
+                include_path_or_none = xml_node.get("path")
+                if include_path_or_none is None:
+                    raise ValueError("No 'path' attribute for include element!")
+                yield from _iterparse_xml(include_path_or_none)
 
+        elif event == "end":
+            depth -= 1
+            if depth == 0:
+                continue
 
-def _read_xml(xml_filepath: str) -> XMLElement:
-    # We are using lxml here, since unlike xml.etree.ElementTree, iterating over
-    # subnodes can be done in document order!
-    xml_tree = lxml.etree.parse(xml_filepath)
-    xml_root = xml_tree.getroot()
-    if xml_root.tag != "visualization":
-        raise bindings.BindingError("XML tree does not start with a <visualization> tag!")
-    return xml_root
+            yield event, xml_node
+
+            # Free this (finished) element, along with its preceding siblings,
+            # which have been handled already
+            xml_node.clear()
+            while xml_node.getprevious() is not None:
+                del xml_node.getparent()[0]
 
 
 def from_xml(xml_filepath: str) -> typing.Tuple[core.LayoutEngine, bindings.BindingTree]:
     """
     Returns a core.LayoutEngine() tree from the given XML file.
     """
-    xml_root = _read_xml(xml_filepath)
     layout_engine = core.LayoutEngine()
     tx = layout_engine.transaction()
     layout_root = tx.node()
 
     binding_tree = bindings.BindingTree.create_root()
-    _create_layout_node_from_xml(layout_root, xml_root, binding_tree)
+    # The elements that are still being parsed, innermost last
+    xml_parents = [_XMLParent(layout_root, binding_tree, None)]
+    for event, xml_node in _iterparse_xml(xml_filepath, root_tag="visualization"):
+        parent = xml_parents[-1]
+        if event == "start":
+            xml_parents.append(_create_layout_node_from_xml(parent, xml_node))
+        elif event == "end":
+            xml_parents.pop()
 
     tx.render()
     return layout_engine, binding_tree
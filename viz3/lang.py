@@ -4,10 +4,10 @@
 Defines a query language used by the XML visualization definition.
 """
 from __future__ import annotations
+import functools
+import re
 import typing
 
-import more_itertools
-
 from . import core
 
 
@@ -15,10 +15,24 @@ class LanguageSyntaxError(Exception):
     pass
 
 
+@functools.lru_cache
+def _is_path_char(ch: str) -> bool:
+    """
+    Returns whether the given character may be part of a path (a part
+    character or '.'). Cached since paths are parsed character by character,
+    and each core.is_valid_path_part() check is a regex match.
+    """
+    return core.is_valid_path_part(ch) or ch == "."
+
+
+@functools.lru_cache(maxsize=4096)
 def _parse_relative_path(text: str, parent_path: typing.Optional[core.Path] = None) -> core.Path:
     """
     Parses text into a core.Path(), with a parent path allowing the given text
     to be relative to the given parent path.
+
+    Cached, since different bindings of an element (e.g. color=".temp|to_color"
+    and text=".temp deg C") often refer to the same relative path.
     """
     if not text.startswith("."):  # absolute path
         return core.Path(text)
@@ -38,6 +52,13 @@ class BindLanguage:
 
     @classmethod
     def from_string(cls, text: str, parent_path: core.Path) -> BindLanguage:
+        return cls._from_string(text, parent_path)
+
+    @classmethod
+    @functools.lru_cache(maxsize=4096)
+    def _from_string(cls, text: str, parent_path: core.Path) -> BindLanguage:
+        # Sibling XML elements repeat the same bindings, so share the parsed
+        # (and never modified) language between them
         keep_when_filtered_out = False
         if text.endswith("!"):
             text = text.rstrip("!")
@@ -82,106 +103,81 @@ class ValueLanguage:
 
         return path
 
-    @classmethod
-    def _skip_while(cls, text_iter, continue_func) -> str:
-        content = ""
-        while True:
-            try:
-                ch = text_iter.peek()
-            except StopIteration:
-                return content
-
-            if not continue_func(ch):
-                break
+    # The _skip_*() and _parse_*() methods below scan text starting at the
+    # given index, returning what was scanned along with the index just after
+    # it. Scanning by index (and slicing out what was scanned) avoids a Python
+    # level iterator call and string concatenation per character.
 
-            next(text_iter)
-            content += ch
+    @classmethod
+    def _skip_while(cls, text: str, i: int, continue_func) -> typing.Tuple[str, int]:
+        j = i
+        text_len = len(text)
+        while j < text_len and continue_func(text[j]):
+            j += 1
 
-        return content
+        return text[i:j], j
 
     @classmethod
-    def _skip_whitespace(cls, text_iter) -> str:
-        return cls._skip_while(text_iter, str.isspace)
+    def _skip_whitespace(cls, text: str, i: int) -> typing.Tuple[str, int]:
+        return cls._skip_while(text, i, str.isspace)
 
     @classmethod
-    def _skip_identifier(cls, text_iter) -> str:
-        after_first = False
-
-        def is_identifier(s):
-            nonlocal after_first
-            if not after_first:
-                return s.isdigit() or s.isidentifier()
-            after_first = True
-            return s.isidentifier()
-
-        return cls._skip_while(text_iter, is_identifier)
+    def _skip_identifier(cls, text: str, i: int) -> typing.Tuple[str, int]:
+        return cls._skip_while(text, i, lambda s: s.isdigit() or s.isidentifier())
 
     @classmethod
-    def _skip_identifier_or_num(cls, text_iter) -> str:
-        return cls._skip_while(text_iter, lambda s: s.isdigit() or s.isidentifier() or s == '.')
+    def _skip_identifier_or_num(cls, text: str, i: int) -> typing.Tuple[str, int]:
+        return cls._skip_while(text, i, lambda s: s.isdigit() or s.isidentifier() or s == '.')
 
     @classmethod
-    def _skip_quote(cls, text_iter) -> str:
-        first_ch = text_iter.peek(default="")
-        if first_ch == "":
-            return ""
-
-        assert first_ch == "'"
-        next(text_iter)
-
-        content = ""
-        while True:
-            try:
-                ch = next(text_iter)
-            except StopIteration:
-                raise ValueError("Unterminated single quote after '{}'".format(content))
-
-            if ch == "'":
-                break
+    def _skip_quote(cls, text: str, i: int) -> typing.Tuple[str, int]:
+        if i >= len(text):
+            return "", i
 
-            content += ch
+        assert text[i] == "'"
+        end_quote_i = text.find("'", i + 1)
+        if end_quote_i == -1:
+            raise ValueError("Unterminated single quote after '{}'".format(text[i + 1:]))
 
-        return content
+        return text[i + 1:end_quote_i], end_quote_i + 1
 
     @classmethod
-    def _parse_path(cls, text_iter, stop_chars, parent_path):
-        is_part_of_path = lambda s: (core.is_valid_path_part(s) or s == ".") and s not in stop_chars
-        path_text = cls._skip_while(text_iter, is_part_of_path)
+    def _parse_path(cls, text: str, i: int, stop_chars, parent_path) \
+            -> typing.Tuple[str, core.Path, int]:
+        is_part_of_path = lambda s: _is_path_char(s) and s not in stop_chars
+        path_text, i = cls._skip_while(text, i, is_part_of_path)
         path = _parse_relative_path("." + path_text, parent_path)
-        return path_text, path
+        return path_text, path, i
 
     @classmethod
-    def _try_parse_language(cls, text_iter, parent_path) \
-            -> typing.Tuple[typing.List[core.Path], typing.List[str], str]:
-        content = ""
+    def _try_parse_language(cls, text: str, i: int, parent_path) \
+            -> typing.Tuple[core.Path, typing.List[str], str, int]:
+        start_i = i
+
         def get_stop_ch():
-            nonlocal content
-            try:
-                _stop_ch = next(text_iter)
-                content += _stop_ch
-            except StopIteration:
-                _stop_ch = ""
-            return _stop_ch
+            nonlocal i
+            if i >= len(text):
+                return ""
+            i += 1
+            return text[i - 1]
 
         assert get_stop_ch() == "."
 
         pipeline = []
         stop_chars = ("|", "?", "")
-        path_content, path = cls._parse_path(text_iter, stop_chars, parent_path)
-        content += path_content
+        _, path, i = cls._parse_path(text, i, stop_chars, parent_path)
 
         stop_ch = get_stop_ch()
         while stop_ch == "|":
-            identifier = cls._skip_identifier(text_iter)
+            identifier, i = cls._skip_identifier(text, i)
             if identifier == "":
                 raise LanguageSyntaxError("Expected identifier for function, "
-                                          "but got none: {}".format(content))
+                                          "but got none: {}".format(text[start_i:i]))
 
-            content += identifier
             pipeline.append(identifier)
             stop_ch = get_stop_ch()
 
-        return path, pipeline, stop_ch
+        return path, pipeline, stop_ch, i
 
     @classmethod
     def from_string(cls, text: str, parent_path: core.Path) -> typing.List[ValueLanguage]:
@@ -200,59 +196,76 @@ class ValueLanguage:
              '.pcp:network-in-bytes|rate'
              'Usage: .usage_bytes bytes'
         """
+        return list(cls._from_string(text, parent_path))
+
+    @classmethod
+    @functools.lru_cache(maxsize=4096)
+    def _from_string(cls, text: str, parent_path: core.Path) -> typing.Tuple[ValueLanguage, ...]:
+        # Sibling XML elements repeat the same attribute values, so share the
+        # parsed languages between them. They are not modified after being
+        # parsed, but the returned list may be, hence the tuple.
         if text == "":
             raise LanguageSyntaxError("Empty string for a binding.")
 
         path = None
         langs = []
-        text_iter = more_itertools.peekable(text)
-        prefix = ""
+        text_len = len(text)
+        i = 0
+        # Joined once a language (or the end) is reached, rather than
+        # concatenated onto as the text is scanned
+        prefix_parts = []
         prev_ch = ""
-        while True:
-            try:
-                ch = text_iter.peek()
-            except StopIteration:
-                break
-
-            if ch == "." and prev_ch != "\\" and not prev_ch.isdigit():
-                path, pipeline, stop_ch = cls._try_parse_language(text_iter, parent_path)
+        while i < text_len:
+            if text[i] == "." and prev_ch != "\\" and not prev_ch.isdigit():
+                path, pipeline, stop_ch, i = cls._try_parse_language(text, i, parent_path)
 
                 default = None
                 has_default = stop_ch == "?"
                 if has_default:
-                    if text_iter.peek(default="") == "'":
-                        default = cls._skip_quote(text_iter)
+                    if i < text_len and text[i] == "'":
+                        default, i = cls._skip_quote(text, i)
                     else:
-                        default = cls._skip_identifier_or_num(text_iter)
+                        default, i = cls._skip_identifier_or_num(text, i)
 
                     stop_ch = default[-1] if default != "" else stop_ch
 
                 lang = ValueLanguage(
                     path,
                     pipeline,
-                    prefix=prefix,
+                    prefix="".join(prefix_parts),
                     default=default,
                 )
                 langs.append(lang)
 
-                prefix = "" if has_default else stop_ch
+                prefix_parts = [] if has_default else [stop_ch]
                 prev_ch = stop_ch
-            else:
-                if prev_ch == "\\" and ch == "n":
-                    prev_ch = "\n"
-                    prefix = prefix[:-1]  # remove newline
-                    prefix += "\n"
-                else:
-                    prev_ch = ch
-                    prefix += ch
+                continue
 
-                next(text_iter)
+            # Plain text up until the next '.' that may start a path (the
+            # character at i is plain text, even if it is an escaped '.')
+            next_dot_i = text.find(".", i + 1)
+            if next_dot_i == -1:
+                next_dot_i = text_len
+
+            plain_text = text[i:next_dot_i]
+            i = next_dot_i
+            if prev_ch == "\\" and plain_text[0] == "n":
+                if prefix_parts:
+                    prefix_parts[-1] = prefix_parts[-1][:-1]  # remove newline
+                prefix_parts.append("\n")
+                plain_text = plain_text[1:]
+                prev_ch = "\n"
+
+            if plain_text:
+                # \n -> newline (the '\' and 'n' are never part of another escape)
+                prefix_parts.append(plain_text.replace("\\n", "\n"))
+                prev_ch = plain_text[-1]
 
         if not langs:
             raise LanguageSyntaxError("No path exists within text: {}".format(text))
 
-        langs[-1].add_suffix(prefix)
-        return langs
+        langs[-1].add_suffix("".join(prefix_parts))
+        return tuple(langs)
 
     @staticmethod
     def looks_valid(text: str) -> bool:
@@ -261,6 +274,23 @@ class ValueLanguage:
         """
         return ":" in text or "(" in text or ")" in text
 
+    @staticmethod
+    def looks_like(text: str) -> bool:
+        """
+        Returns whether the text may contain a value language, i.e. whether
+        there is a '.' that could start a path (one not escaped nor following
+        a digit). Text for which this is False is guaranteed to be rejected by
+        from_string().
+        """
+        dot_i = text.find(".")
+        while dot_i != -1:
+            prev_ch = text[dot_i - 1] if dot_i > 0 else ""
+            if prev_ch != "\\" and not prev_ch.isdigit():
+                return True
+            dot_i = text.find(".", dot_i + 1)
+
+        return False
+
     def prefix(self) -> str:
         """
         Returns the string before the pipeline.
@@ -316,7 +346,11 @@ class ValueLanguage:
 
 class FilterLanguage:
 
-    def __init__(self, path: core.Path, selector: typing.Set[typing.Optional[str]], is_negative: bool, is_regex: bool):
+    # Equal selectors (e.g. {1,2} on many sibling elements) share one frozenset
+    _interned_selectors: typing.Dict[typing.FrozenSet[typing.Optional[str]],
+                                     typing.FrozenSet[typing.Optional[str]]] = {}
+
+    def __init__(self, path: core.Path, selector: typing.FrozenSet[typing.Optional[str]], is_negative: bool, is_regex: bool):
         """
         Defines a simple query language.
         """
@@ -324,19 +358,33 @@ class FilterLanguage:
         self._selector = selector
         self._is_negative = is_negative
         self._is_regex = is_regex
+        # Compiled once here, rather than for every value that is filtered
+        self._compiled_selector = ()
+        if is_regex:
+            try:
+                self._compiled_selector = tuple(re.compile(part) for part in selector if part is not None)
+            except re.error as err:
+                raise LanguageSyntaxError("Invalid regex in filter language "
+                                          "selector {}: {}".format(selector, err))
 
     @classmethod
-    def _parse_selector(self, text: str) -> typing.Set[typing.Optional[str]]:
-        if text.startswith("{"):
-            if not text.endswith("}"):
-                raise LanguageSyntaxError("Started to apply set match "
-                                          "'{value,...}', but no '}' at the end!")
-
-            # FIXME: If ',' appears in a part, things will be parsed incorrectly!
-            parts = text.lstrip("{").rstrip("}").split(",")
-        else:
-            parts = [text]
+    def _parse_selector(self, text: str) -> typing.FrozenSet[typing.Optional[str]]:
+        if not text.startswith("{"):
+            # Most selectors are a single value, e.g. .data=foo
+            if text.lower() == "null":
+                selector = frozenset({None})
+            elif text == "":  # erroneous; ignore
+                selector = frozenset()
+            else:
+                selector = frozenset({text.strip("'").strip()})
+            return self._interned_selectors.setdefault(selector, selector)
+
+        if not text.endswith("}"):
+            raise LanguageSyntaxError("Started to apply set match "
+                                      "'{value,...}', but no '}' at the end!")
 
+        # FIXME: If ',' appears in a part, things will be parsed incorrectly!
+        parts = text.lstrip("{").rstrip("}").split(",")
         selector = set()
         for part in parts:
             if part.lower() == "null":
@@ -346,7 +394,8 @@ class FilterLanguage:
             else:
                 selector.add(part.strip("'").strip())
 
-        return selector
+        selector = frozenset(selector)
+        return self._interned_selectors.setdefault(selector, selector)
 
     @classmethod
     def from_string(cls, text: str, parent_path: core.Path) -> FilterLanguage:
@@ -372,6 +421,13 @@ class FilterLanguage:
             ".path.to={1,2}"
             "~{'^foo', 'bar$'}"
         """
+        return cls._from_string(text, parent_path)
+
+    @classmethod
+    @functools.lru_cache(maxsize=4096)
+    def _from_string(cls, text: str, parent_path: core.Path) -> FilterLanguage:
+        # Sibling XML elements repeat the same filters, so share the parsed
+        # (and never modified) language between them
         text = text.strip()
         if not cls.looks_valid(text):
             raise LanguageSyntaxError("Could not find '=' nor '~' in filter "
@@ -417,7 +473,7 @@ class FilterLanguage:
         """
         return self._path
 
-    def selector(self) -> typing.Set[typing.Optional[str]]:
+    def selector(self) -> typing.FrozenSet[typing.Optional[str]]:
         """
         Returns the selector (e.g. {"foo"} of .data=foo, or {None} of .data=null
         or {1,2} of .data={1,2}) found in the language.
@@ -435,3 +491,10 @@ class FilterLanguage:
         Whether the selector should NOT be matched against.
         """
         return self._is_regex
+
+    def compiled_selector(self) -> typing.Tuple[typing.Pattern, ...]:
+        """
+        Returns the compiled regexes of the selector if it is a regex,
+        otherwise an empty tuple.
+        """
+        return self._compiled_selector
@@ -36,8 +36,14 @@ def add_renderer_args(parser: argparse.ArgumentParser):
     Configures an argparse ArgumentParser with options to pick a default
     builtin renderer (e.g. web or panda3d).
 
-    Use from_args() to return a AbstractRenderer from the parsed args.
+    Use from_args() to return a AbstractRenderer from the parsed args. Adding
+    the options to the same parser more than once does nothing.
     """
+    # argparse would otherwise raise on the conflicting --web/--panda3d options
+    if getattr(parser, "_viz3_renderer_args_added", False):
+        return
+    parser._viz3_renderer_args_added = True
+
     renderer_group = parser.add_mutually_exclusive_group()
     renderer_group.add_argument(
         "--web", "-w",
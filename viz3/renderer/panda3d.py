@@ -4,6 +4,7 @@
 Renders a LayoutEngine tree using Panda3D.
 """
 import logging
+import time
 
 # Direct is part of panda3d; it is mostly the non-3D parts of Panda3D
 import direct.showbase.ShowBase
@@ -25,6 +26,9 @@ class Panda3dRenderer(direct.showbase.ShowBase.ShowBase, renderer.AbstractRender
 
     .run() runs the Renderer. Should be on main thread.
     """
+    # How long to handle events for in a frame, leaving the rest of the frame
+    # (at 60fps) for rendering; the remaining events are handled next frame
+    event_time_budget_secs = 0.012
 
     def __init__(self, layout_engine, title="3D Visualizer"):
         """
@@ -50,8 +54,18 @@ class Panda3dRenderer(direct.showbase.ShowBase.ShowBase, renderer.AbstractRender
         self._mouse_collision_ray = panda3d.core.CollisionRay()
         mouse_collision_node.addSolid(self._mouse_collision_ray)
         self._mouse_collision_picker.addCollider(self._mouse_collision_node_path, self._mouse_collision_queue)
+        # What the last mouse hover collision test was done with (see
+        # _hover_state()), and whether the scene changed since then
+        self._last_hover_state = None
+        self._scene_changed_since_hover = False
         taskMgr.add(self._on_mouse_hover)
 
+        # Geometry names to their NodePath, so events need not search the
+        # scene graph (with render.find()) for the node they apply to
+        self._node_paths = {}
+        # Move events not yet applied, by geometry name (see _move_from_event)
+        self._pending_move_events = {}
+
         self._listener = self.request_listener()
         taskMgr.add(self._poll_and_handle_events)
 
@@ -65,19 +79,23 @@ class Panda3dRenderer(direct.showbase.ShowBase.ShowBase, renderer.AbstractRender
 
             See https://docs.panda3d.org/1.10/python/programming/tasks-and-events/tasks
         """
-        start_time = task.time
+        # task.time is the frame time, which does not advance while we handle
+        # events, so measure how long they take with the wall clock
+        start_time = time.perf_counter()
         while True:
             server_died, maybe_event = self._listener.poll()
             if server_died:
                 logger.warning("Event server died. Proceeding without updates.")
+                self._apply_pending_moves()
                 return direct.task.Task.done
 
             if maybe_event:
                 self._update_from_event(maybe_event)
                 # if we have time to process additional events (at 60fps)
-                if task.time - start_time < 0.015:
+                if time.perf_counter() - start_time < self.event_time_budget_secs:
                     continue
 
+            self._apply_pending_moves()
             return direct.task.Task.cont
 
     def _update_from_event(self, event):
@@ -92,6 +110,12 @@ class Panda3dRenderer(direct.showbase.ShowBase.ShowBase, renderer.AbstractRender
             logger.debug("Not drawing event %s %s", event.path, event.type.name)
             return
 
+        self._scene_changed_since_hover = True
+
+        if event.type != core.EventType.Move:
+            # Other events may remove or replace the nodes moves apply to
+            self._apply_pending_moves()
+
         if event.type == core.EventType.Move:
             logger.debug("Moving from event %s", event.path)
             self._move_from_event(event)
@@ -132,16 +156,27 @@ class Panda3dRenderer(direct.showbase.ShowBase.ShowBase, renderer.AbstractRender
 
     def _move_from_event(self, event):
         """
-        Moves the corresponding node associated with the given event.
+        Moves the corresponding node associated with the given event, once
+        _apply_pending_moves() is called. A node that is moved several times
+        before then is only moved to its last position.
 
         event: core.Event
             An event from the LayoutEngine event server.
         """
-        target_node_path = self._find_node_path(event.path)
-        pos = event.geometry.pos
+        self._pending_move_events[self._name_from_path(event.path)] = event
+
+    def _apply_pending_moves(self):
+        """
+        Moves the nodes of the Move events given to _move_from_event().
+        """
+        for event in self._pending_move_events.values():
+            target_node_path = self._find_node_path(event.path)
+            pos = event.geometry.pos
+
+            coord = utils.swap_yz_coords(pos)
+            self._move_node_path(target_node_path, coord)
 
-        coord = utils.swap_yz_coords(pos)
-        self._move_node_path(target_node_path, coord)
+        self._pending_move_events.clear()
 
     def _add_from_event(self, event):
         """
@@ -152,9 +187,12 @@ class Panda3dRenderer(direct.showbase.ShowBase.ShowBase, renderer.AbstractRender
         """
         name = self._name_from_path(event.path)
         target_node_path = self._node_path_from_viz3_geometry(name, event.geometry)
+        self._node_paths[name] = target_node_path
 
         target_node_path.setTransparency(True)
-        target_node_path.setColor(*self._color_from_viz3_rgba(event.geometry.color))
+        # The vertexes have no color (i.e. are white), so scaling the color
+        # gives the color; see _recolor_from_event()
+        target_node_path.setColorScale(*self._color_from_viz3_rgba(event.geometry.color))
         target_node_path.node().setIntoCollideMask(self._mouse_collision_node_path.node().getDefaultCollideMask())
 
     def _remove_from_event(self, event):
@@ -164,7 +202,11 @@ class Panda3dRenderer(direct.showbase.ShowBase.ShowBase, renderer.AbstractRender
         event: core.Event
             An event from the LayoutEngine event server.
         """
-        target_node_path = self._find_node_path(event.path)
+        name = self._name_from_path(event.path)
+        target_node_path = self._node_paths.pop(name, panda3d.core.NodePath())
+        if not target_node_path.isEmpty():
+            # The label refers back to the node through its parent
+            target_node_path.clearPythonTag(self._text_label_tag())
         target_node_path.removeNode()
 
     def _resize_from_event(self, event):
@@ -174,13 +216,18 @@ class Panda3dRenderer(direct.showbase.ShowBase.ShowBase, renderer.AbstractRender
         event: core.Event
             An event from the LayoutEngine event server.
         """
-        # FIXME: This is a hack because in Panda3d Geom objects are supposed
-        #        to not change their physical properties; we should switch
-        #        to using an Actor if things change instead (e.g. we could be
-        #        lazy about it and only do it when we encouter a resize since
-        #        we are already recreating a new object on each resize)
-        self._remove_from_event(event)
-        self._add_from_event(event)
+        target_node_path = self._find_node_path(event.path)
+        if target_node_path.isEmpty():
+            self._add_from_event(event)
+            return
+
+        # Geoms are not supposed to change their physical properties in
+        # Panda3D, so swap in a new Geom, but keep the node (and its label,
+        # LOD and render state), rather than removing and adding the node
+        geometry = event.geometry
+        target_node_path.node().setGeom(0, self._geom_from_viz3_geometry(geometry))
+        target_node_path.setPos(*utils.swap_yz_coords(geometry.pos))
+        target_node_path.setColorScale(*self._color_from_viz3_rgba(geometry.color))
 
     def _recolor_from_event(self, event):
         """
@@ -191,7 +238,10 @@ class Panda3dRenderer(direct.showbase.ShowBase.ShowBase, renderer.AbstractRender
         """
         target_node_path = self._find_node_path(event.path)
         color = event.geometry.color
-        target_node_path.setColor(*self._color_from_viz3_rgba(color))
+        # Changing the color scale, unlike setColor(), does not change the
+        # color attribute of the node's render state, which is cheaper when
+        # nodes are recolored often
+        target_node_path.setColorScale(*self._color_from_viz3_rgba(color))
 
     def _retext_from_event(self, event):
         """
@@ -219,11 +269,9 @@ class Panda3dRenderer(direct.showbase.ShowBase.ShowBase, renderer.AbstractRender
             viz3 Path to look for.
         """
         name = self._name_from_path(path)  # core geometry names are their paths
-        maybe_node_path = self.render.find(name)
-        if not maybe_node_path:
-            return self.render.find(self._lod_name(name) + "/" + name)  # see _create_lod
-
-        return maybe_node_path
+        # The node may be under a LOD node (see _create_lod), but its NodePath
+        # is the same either way
+        return self._node_paths.get(name, panda3d.core.NodePath())
 
     def _lod_name(self, parent_name):
         return parent_name + "_lod"
@@ -248,6 +296,9 @@ class Panda3dRenderer(direct.showbase.ShowBase.ShowBase, renderer.AbstractRender
     def _hoverable_tag(self):
         return "hoverable"
 
+    def _text_label_tag(self):
+        return "text_label"
+
     def _create_text_label(self, text, node_path):
         """
         Returns a new text node path parented to the given node path.
@@ -262,12 +313,17 @@ class Panda3dRenderer(direct.showbase.ShowBase.ShowBase, renderer.AbstractRender
         # Point towards user; See
         # https://docs.panda3d.org/1.10/python/programming/render-effects/billboard?highlight=setdepthwrite#billboard-effects
         text_path = node_path.attachNewNode(text_node)
+        # Otherwise the parent's color scale (its color) tints the label
+        text_path.setColorScaleOff()
         text_path.setBillboardPointEye(-50, fixed_depth=True)
         text_path.setBin("fixed", 0)
         text_path.setDepthWrite(False)
         text_path.setDepthTest(False)
 
         node_path.setTag(self._hoverable_tag(), text_path.getName())
+        # Looked up when hovering (every frame), so keep the label at hand,
+        # rather than searching the parent's children for it
+        node_path.setPythonTag(self._text_label_tag(), text_path)
 
         text_path.stash()  # Hide until hovered
         return text_path
@@ -278,17 +334,13 @@ class Panda3dRenderer(direct.showbase.ShowBase.ShowBase, renderer.AbstractRender
         associated, or an empty (.isEmpty()) node path if there is no associated
         text label.
         """
-        text_label_name = self._text_label_name(parent_node_path.getName())
+        # See _create_text_label(); this also finds .stash()ed labels, which
+        # are not given with .getChildren()
+        text_node_path = parent_node_path.getPythonTag(self._text_label_tag())
+        if text_node_path is None:
+            return panda3d.core.NodePath()
 
-        # We .stash() text nodes that are not currently being displayed; these
-        # are not given with .getChildren() and other children are not given
-        # with .getStashedChildren()
-        children_paths = list(parent_node_path.getStashedChildren()) + list(parent_node_path.getChildren())
-        for child_node_path in children_paths:
-            if child_node_path.getName() == text_label_name:
-                return child_node_path
-
-        return panda3d.core.NodePath()
+        return text_node_path
 
     def _parent_from_text_label(self, text_node_path):
         """
@@ -298,32 +350,42 @@ class Panda3dRenderer(direct.showbase.ShowBase.ShowBase, renderer.AbstractRender
         tag = self._hoverable_tag()
         return text_node_path.findNetTag(tag)
 
-    def _node_path_from_viz3_geometry(self, name, geometry):
+    def _geom_from_viz3_geometry(self, geometry):
         """
-        Creates a new node from the given viz3 geometry.
+        Creates a new Geom with the vertexes and triangles of the given viz3
+        geometry.
         """
         # See https://docs.panda3d.org/1.10/python/programming/internal-structures/procedural-generation/index
-        v_rgba_fmt = panda3d.core.GeomVertexFormat.get_v3cp()
+        # No color column; vertexes without a color are drawn white, and the
+        # geometry's color is applied with a color scale instead (see
+        # _add_from_event())
+        v_fmt = panda3d.core.GeomVertexFormat.get_v3()
 
         # Static -> We'll only be fillling in vertices once
-        v_data = panda3d.core.GeomVertexData(":viz3geometry:", v_rgba_fmt, panda3d.core.Geom.UHStatic)
-        v_data.setNumRows(len(geometry.vertexes()))
-        v_col_writer = panda3d.core.GeomVertexWriter(v_data, 'vertex')
-        v_color_writer = panda3d.core.GeomVertexWriter(v_data, 'color')
-        for pt in geometry.vertexes():
-            v_col_writer.addData3(utils.swap_yz_coords(pt))
-            # Need to set color for each row
-            v_color_writer.addData4(*self._color_from_viz3_rgba(geometry.color))
+        v_data = panda3d.core.GeomVertexData(":viz3geometry:", v_fmt, panda3d.core.Geom.UHStatic)
+        # This crosses into the C++ core and copies, so only do it once,
+        # rather than once per vertex
+        vertex_coords = geometry.vertex_coords()
+        v_data.setNumRows(len(vertex_coords))
+        add_vertex = panda3d.core.GeomVertexWriter(v_data, 'vertex').addData3
+        for coord in utils.swap_yz_coords_bulk(vertex_coords):
+            add_vertex(coord)
 
         triangle = panda3d.core.GeomTriangles(panda3d.core.Geom.UHStatic)
         geom = panda3d.core.Geom(v_data)
+        add_triangle = triangle.addVertices
         for tri in geometry.triangles():
-            triangle.addVertices(*tri)
+            add_triangle(*tri)
 
         geom.addPrimitive(triangle)
+        return geom
 
+    def _node_path_from_viz3_geometry(self, name, geometry):
+        """
+        Creates a new node from the given viz3 geometry.
+        """
         node = panda3d.core.GeomNode(name)
-        node.addGeom(geom)
+        node.addGeom(self._geom_from_viz3_geometry(geometry))
         node_path = self.render.attachNewNode(node)
 
         if geometry.hide_distance > 0 or geometry.show_distance < float("inf"):
@@ -392,6 +454,15 @@ class Panda3dRenderer(direct.showbase.ShowBase.ShowBase, renderer.AbstractRender
             return direct.task.Task.cont
 
         mouse_pos = self.mouseWatcherNode.getMouse()
+        # Traversing the whole scene for collisions is costly, so only do so
+        # when what is under the mouse may have changed
+        hover_state = self._hover_state(mouse_pos)
+        if hover_state == self._last_hover_state and not self._scene_changed_since_hover:
+            return direct.task.Task.cont
+
+        self._last_hover_state = hover_state
+        self._scene_changed_since_hover = False
+
         self._mouse_collision_ray.setFromLens(self.camNode, mouse_pos.getX(), mouse_pos.getY())
         self._mouse_collision_picker.traverse(self.render)
 
@@ -430,6 +501,19 @@ class Panda3dRenderer(direct.showbase.ShowBase.ShowBase, renderer.AbstractRender
 
         return direct.task.Task.cont
 
+    def _hover_state(self, mouse_pos):
+        """
+        Returns what the mouse collision ray depends on: the mouse position,
+        and the camera's position and lens.
+        """
+        # Copied, since these may refer to matrices Panda3D later modifies
+        return (
+            mouse_pos.getX(),
+            mouse_pos.getY(),
+            panda3d.core.LMatrix4(self.camera.getMat(self.render)),
+            panda3d.core.LMatrix4(self.camLens.getProjectionMat()),
+        )
+
     def _color_from_viz3_rgba(self, rgb):
         """
         Returns a new Panda3d color from the given viz3 RGB color.
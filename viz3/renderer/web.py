@@ -19,70 +19,108 @@ logger = logging.getLogger(__name__)
 logger.setLevel(logging.DEBUG)
 
 
+def _json_float(value: float) -> float:
+    # FLT_MAX in float.h (assuming 32-bit floats); infinity is not
+    # representible in JSON
+    return value if value != float("inf") else 3.40282347e+38
+
+
 class EventJSONEncoder(json.JSONEncoder):
     """
     Encodes viz3 objects to JSON.
 
     Usage: EventJSONEncoder().encode(...)
     """
+    # Events whose geometry's shape (vertexes, triangles and bounds) is used
+    # by main.js; the shape of other events is left out, since it is by far
+    # the largest part of the event to encode and send
+    shape_event_types = (core.EventType.Add, core.EventType.Resize)
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # default() is called for every viz3 object within an event, so look
+        # up how to encode it by its type, rather than with isinstance() checks
+        self._encoders = {
+            core.Event: self._encode_event,
+            core.Path: str,
+            core.Point: self._encode_point,
+            core.RGBA: self._encode_rgba,
+            core.Geometry: self._encode_geometry,
+            core.Bounds: self._encode_bounds,
+            core.EventType: int,
+            float: _json_float,
+        }
 
     def default(self, obj):
-        if isinstance(obj, core.Event):
-            return {
-                "path": self.default(obj.path),
-                "geometry": self.default(obj.geometry),
-                "event_type": self.default(obj.type),
-            }
-        elif isinstance(obj, core.Path):
-            return str(obj)
-        elif isinstance(obj, core.Point):
-            return {
-                "x": obj.x,
-                "y": obj.y,
-                "z": obj.z,
-            }
-        elif isinstance(obj, core.RGBA):
-            return {
-                "r": obj.r,
-                "g": obj.g,
-                "b": obj.b,
-                "a": obj.a
-            }
-        elif isinstance(obj, core.Geometry):
-            # We map objects to self.default if and only if there is no
-            # corresponding representation in JSON (except for float, since
-            # we need to map inf to a special value).
-            # e.g. self.default(return_bool()) is not allowed. In fact, it will
-            #      cause an exception to be raised
-            return {
-                "vertexes": list(map(self.default, obj.vertexes())),
-                "triangles": obj.triangles(),
-                "bounds": self.default(obj.bounds()),
-                "pos": self.default(obj.pos),
-                "color": self.default(obj.color),
-                "hide_distance": self.default(obj.hide_distance),
-                "show_distance": self.default(obj.show_distance),
-                "should_draw": obj.should_draw(),
-                "text": obj.text,
-            }
-        elif isinstance(obj, core.Bounds):
-            return {
-                "base": self.default(obj.base()),
-                "end": self.default(obj.end()),
-            }
-        elif isinstance(obj, core.EventType):
-            return int(obj)
-        elif isinstance(obj, float):
-            # FLT_MAX in float.h (assuming 32-bit floats); infinity is not
-            # representible in JSON
-            return obj if obj != float("inf") else 3.40282347e+38
-        return super().default(obj)
+        encode = self._encoders.get(type(obj))
+        if encode is None:
+            return super().default(obj)
+        return encode(obj)
+
+    def _encode_event(self, event: core.Event):
+        if event.type in self.shape_event_types:
+            geometry = self._encode_geometry(event.geometry)
+        else:
+            geometry = self._encode_shapeless_geometry(event.geometry)
+
+        return {
+            "path": str(event.path),
+            "geometry": geometry,
+            "event_type": int(event.type),
+        }
+
+    @staticmethod
+    def _encode_point(point: core.Point):
+        return {
+            "x": point.x,
+            "y": point.y,
+            "z": point.z,
+        }
+
+    @staticmethod
+    def _encode_rgba(rgba: core.RGBA):
+        return {
+            "r": rgba.r,
+            "g": rgba.g,
+            "b": rgba.b,
+            "a": rgba.a
+        }
+
+    def _encode_bounds(self, bounds: core.Bounds):
+        return {
+            "base": self._encode_point(bounds.base()),
+            "end": self._encode_point(bounds.end()),
+        }
+
+    def _encode_geometry(self, geometry: core.Geometry):
+        # Everything is encoded here (or is natively representable in JSON),
+        # except for floats, since we need to map inf to a special value, so
+        # the JSON encoder need not call default() for each vertex
+        encoded = {
+            "vertexes": [{"x": x, "y": y, "z": z} for x, y, z in geometry.vertex_coords()],
+            "triangles": geometry.triangles(),
+            "bounds": self._encode_bounds(geometry.bounds()),
+        }
+        encoded.update(self._encode_shapeless_geometry(geometry))
+        return encoded
+
+    def _encode_shapeless_geometry(self, geometry: core.Geometry):
+        return {
+            "pos": self._encode_point(geometry.pos),
+            "color": self._encode_rgba(geometry.color),
+            "hide_distance": _json_float(geometry.hide_distance),
+            "show_distance": _json_float(geometry.show_distance),
+            "should_draw": geometry.should_draw(),
+            "text": geometry.text,
+        }
 
 
 static_dir = pkg_resources.resource_filename("viz3", "static/")
 
 
 class WebRenderer(renderer.AbstractRenderer):
+    # Roughly how many characters of events to send in one response chunk
+    max_chunk_size = 4096
 
     def __init__(self, layout_engine: core.LayoutEngine, host: str = "0.0.0.0", port: int = 8493):
         """
@@ -101,14 +139,31 @@ class WebRenderer(renderer.AbstractRenderer):
         def events():
             def stream_events():
                 listener = self.request_listener()
+                # Events contain no reference cycles, so skip checking for them
+                encoder = EventJSONEncoder(check_circular=False)
                 while True:
                     # For some reason listen() causes problems with locking
                     maybe_event = listener.listen()
                     if not maybe_event:
                         return
 
-                    json_data = EventJSONEncoder().encode(maybe_event)
-                    yield "data:{}\n\n".format(json_data)
+                    # Send the events that are already available along with
+                    # this one, rather than as a response chunk each
+                    messages = []
+                    messages_size = 0
+                    server_died = False
+                    while maybe_event:
+                        message = "data:{}\n\n".format(encoder.encode(maybe_event))
+                        messages.append(message)
+                        messages_size += len(message)
+                        if messages_size >= self.max_chunk_size:
+                            break
+
+                        server_died, maybe_event = listener.poll()
+
+                    yield "".join(messages)
+                    if server_died:
+                        return
 
             return flask.Response(stream_events(), mimetype="text/event-stream")
 
@@ -4,6 +4,7 @@
 Defines a series of value transformations used when applying data from
 data nodes (in the DataGraph) to LayoutEngine element attributes.
 """
+import functools
 import typing
 
 from . import colors
@@ -17,8 +18,15 @@ TransformationFunc = typing.Callable[[typing.Any], typing.Any]
 TransformationFuncMap = typing.Dict[str, TransformationFunc]
 
 
+@functools.lru_cache
+def _fractional_color_range(color_range_ctor) -> colors.InterpolatedColorRange:
+    # Color ranges are not modified once constructed, so share one per kind
+    # rather than constructing one for every value transformed
+    return color_range_ctor(0.0, 1.0)
+
+
 def _pct_color_range(fractional_value: float, color_range_ctor=colors.RedBlueColorRange):
-    color_range = color_range_ctor(0.0, 1.0)
+    color_range = _fractional_color_range(color_range_ctor)
     return [color_range.rgb_color(fractional_value)]
 
 
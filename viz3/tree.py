@@ -35,7 +35,10 @@ class Tree:
             assert parent is None
 
         self._parent = parent
-        self._children: typing.List[Tree] = []
+        # Children by name, in the order they were added
+        self._children: typing.Dict[str, Tree] = {}
+        # Computed on first use; the name and parent of a node never change
+        self._path: typing.Optional[core.Path] = None
 
     def name(self) -> str:
         """
@@ -59,50 +62,53 @@ class Tree:
         """
         Returns whether this node has any children nodes.
         """
-        return len(self._children) == 0
+        return len(self._children) > 0
 
     def find_descendant(self, with_path: core.Path):
         """
         Returns a descendant node with the given path or raises IndexError if
         no such descendant exists.
         """
-        for child_node in self._children:
-            if child_node.name() != with_path.first():
-                continue
+        # Walk down by name, rather than recursing with a new Path per level
+        parts = with_path.parts()
+        node = self
+        for i, part in enumerate(parts):
+            child_node = node._children.get(part)
+            if child_node is None:
+                if i == len(parts) - 1 and node.name() == part:
+                    return node
+                raise IndexError("Could not find descendant with path {}".format(with_path))
 
-            if with_path.is_leaf():
-                return child_node
+            node = child_node
 
-            return child_node.find_descendant(with_path.without_first())
-
-        if with_path.is_leaf() and self.name() == with_path.first():
-            return self
-
-        raise IndexError("Could not find descendant with path {}".format(with_path))
+        return node
 
     def path(self) -> core.Path:
         """
         Returns a viz3.Path() to this node in the tree.
         """
-        if self.is_root():
-            return core.Path()
-        return self.parent().path() + self.name()  # type: ignore
+        if self._path is None:
+            if self.is_root():
+                self._path = core.Path()
+            else:
+                self._path = self.parent().path() + self.name()  # type: ignore
+        return self._path
 
     def _children_names(self) -> typing.List[str]:
         """
         Returns a list of children names. Should only be used
         by subclasses.
         """
-        return [child.name() for child in self._children]
+        return list(self._children.keys())
 
     def _add_child(self, new_child):
         """
         Adds a new child node to this node. Should only be used
         by subclasses.
         """
-        assert not any(child.name() == new_child.name() for child in self._children)
+        assert new_child.name() not in self._children
         assert self != new_child
-        self._children.append(new_child)
+        self._children[new_child.name()] = new_child
         return new_child
 
     def _replace_child(self, replacing_child):
@@ -111,34 +117,42 @@ class Tree:
         by subclasses.
         """
         name = replacing_child.name()
-        for i, child in enumerate(self._children):
-            if child.name() == name:
-                self._children[i] = replacing_child
-                return
-        raise ValueError("Tried to replace non-existent child!")
+        if name not in self._children:
+            raise ValueError("Tried to replace non-existent child!")
+        self._children[name] = replacing_child
 
     def _get_child(self, child_name: str):
         """
         Returns a child node of this node. Should only be used
         by subclasses.
         """
-        for child in self._children:
-            if child.name() == child_name:
-                return child
-        raise IndexError("Could not find child with name: " + child_name)
+        try:
+            return self._children[child_name]
+        except KeyError:
+            raise IndexError("Could not find child with name: " + child_name)
 
     def __getitem__(self, item):
         if isinstance(item, int):
-            return self._children[item]
+            return list(self._children.values())[item]
         elif isinstance(item, Tree):
-            return self._children.index(item)
+            return list(self._children.values()).index(item)
         elif isinstance(item, str):
             return self._get_child(item)
         else:
             raise TypeError("Indexes into a subtree must be either a integer, "
                             "Tree, or a string.")
 
+    def __len__(self) -> int:
+        """
+        Returns the number of children of this node.
+        """
+        return len(self._children)
+
+    def __bool__(self) -> bool:
+        # Without this, a node without children would be falsy (see __len__)
+        return True
+
     def __iter__(self):
-        for child in self._children.copy():
+        for child in list(self._children.values()):
             assert child != self
             yield child
@@ -11,6 +11,9 @@ import re
 from . import core
 
 
+_class_repr_regex = re.compile(r"<class '(\S+)'>")
+
+
 def class_name(cls: type):
     """
     Returns the name of the given class.
@@ -22,7 +25,7 @@ def class_name(cls: type):
         # dunno why, so this is a dirty hack that someone more
         # knowledgable should fix....
         # FIXME: Replace this hack with something better
-        match_or_none = re.match(r"<class '(\S+)'>", str(type(cls)))
+        match_or_none = _class_repr_regex.match(str(type(cls)))
         if not match_or_none:
             obj_name = str(type(cls))
         else:
@@ -42,6 +45,14 @@ def swap_yz_coords(coord: core.Point):
     return coord.x, coord.z, coord.y
 
 
+def swap_yz_coords_bulk(coords: typing.Iterable[typing.Tuple[float, float, float]]) -> typing.List[typing.Tuple[float, float, float]]:
+    """
+    Returns swap_yz_coords() of each of the given (x, y, z) tuples, without a
+    function call per coord (e.g. for all the Geometry.vertex_coords()).
+    """
+    return [(x, z, y) for x, y, z in coords]
+
+
 # Path() can store a DataTree path, or a LayoutEngine path; help the programmer
 # slightly by adding an alias here.
 LayoutPath = typing.NewType("LayoutPath", core.Path)
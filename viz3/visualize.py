@@ -7,7 +7,8 @@ graph and mapping that onto "templates" of 3D LayoutEngine nodes.
 """
 from __future__ import annotations
 
-import collections
+import dataclasses
+import functools
 import typing
 import logging
 
@@ -23,12 +24,34 @@ logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
 
 
+# Called for each value of each binding, and values (e.g. hostnames) repeat
+# across bindings and updates; typed -> 1 and 1.0 are not mangled the same
+@functools.lru_cache(maxsize=8192, typed=True)
 def mangle_value_into_path_part(value: typing.Any):
     if value is None:
         return "null"
     return str(value).replace(".", "_").replace(" ", "__").replace(":", "_port_")
 
 
+@dataclasses.dataclass(frozen=True)
+class _BindingPlan:
+    """
+    What walking a binding node needs to know about its binding, which does
+    not change between walks (see DynamicVisualization._binding_plan()).
+    """
+    binding: bindings.Binding
+    data_path: core.Path
+    attr_bindings: typing.List[bindings.AttributeBinding]
+    # The layout path from the parent binding's layout path, without its last
+    # part; each value's layout path only differs in the last part
+    intermediate_layout_path_prefix: core.Path
+    # The last part, which is suffixed with the value (and its count)
+    instance_name_prefix: str
+    # Whether the binding's filter is on the bound data node itself, so that
+    # it only depends on each value (see _query_values())
+    filters_own_values: bool
+
+
 class DynamicVisualization:
 
     def __init__(self, layout_engine: core.LayoutEngine, data_graph: datagraph.DataGraph, binding_tree: bindings.BindingTree):
@@ -40,6 +63,16 @@ class DynamicVisualization:
         self._data_graph = data_graph
         self._binding_tree = binding_tree
         self._transformation_map = tr.default_transformations()
+        # Values of each data path for each set of ancestor values seen during
+        # a _walk(); see _query_result_values()
+        self._values_cache: typing.Dict[typing.Tuple[core.Path, typing.FrozenSet], typing.Tuple[list, dict]] = {}
+        # Whether to log debug messages during a _walk(); see _walk()
+        self._log_debug = False
+        # See _binding_plan()
+        self._binding_plans: typing.Dict[bindings.BindingTree, _BindingPlan] = {}
+        # Data nodes to the nodes adapted from them, and the function adapting
+        # their values, during a _walk(); see _walk_impl()
+        self._node_adaptations: typing.Dict[datagraph.DataNode, typing.List[typing.Tuple[datagraph.DataNode, typing.Callable]]] = {}
 
     def add_transformation(self, name: str, transformation_func: tr.TransformationFunc):
         """
@@ -139,19 +172,33 @@ class DynamicVisualization:
           </juxtapose>
         """
         logger.info("Exploding layout tree")
+        # Bound nodes share their parent with their siblings, and are often
+        # the parent of the nodes bound below them, so remember the nodes by
+        # their path, rather than finding each parent from the root
+        nodes_by_path: typing.Dict[core.Path, core.Node] = {}
+        # Checked once, rather than building debug messages (or their
+        # arguments, such as the bound node's element) for every value
+        log_debug = logger.isEnabledFor(logging.DEBUG)
         for binding, resolved_layout_path, attribute_map in self._walk(constraints):
             instance = resolved_layout_path.last()
             template_name = binding.layout_path().last()
-            parent_of_bound_node = root_node.find_descendant(resolved_layout_path.without_last())
+            parent_path = resolved_layout_path.without_last()
+            parent_of_bound_node = nodes_by_path.get(parent_path)
+            if parent_of_bound_node is None:
+                parent_of_bound_node = root_node.find_descendant(parent_path)
+                nodes_by_path[parent_path] = parent_of_bound_node
 
             if not parent_of_bound_node.has_child(instance):
-                logger.debug("Making template %s with instance %s", template_name, instance)
+                if log_debug:
+                    logger.debug("Making template %s with instance %s", template_name, instance)
                 bound_node = parent_of_bound_node.try_get_child_or_make_template(template_name, instance)
             else:
                 bound_node = parent_of_bound_node.try_get_child(instance)
 
             assert bound_node is not None
-            logger.debug("Updating element %s with map %s", bound_node.element, attribute_map)
+            nodes_by_path[resolved_layout_path] = bound_node
+            if log_debug:
+                logger.debug("Updating element %s with map %s", bound_node.element, attribute_map)
             bound_node.element.update_from_attributes(attribute_map)
 
     def _walk(self, constraints: typing.Dict[str, str]) \
@@ -168,16 +215,44 @@ class DynamicVisualization:
         for mangled_name, expected_value in constraints.items():
             ancestor_node_values[self._data_graph.find_with_mangled_name(mangled_name)] = expected_value
 
-        yield from self._walk_impl(self._binding_tree, core.Path(), ancestor_node_values, result_graph)
+        # The data (and its adaptors) may have changed since the last walk
+        self._values_cache = {}
+        self._node_adaptations = {}
+        # Checked once per walk, rather than for each debug message of each
+        # value
+        self._log_debug = logger.isEnabledFor(logging.DEBUG)
+
+        # Walk the binding tree depth-first with a stack of the walks of each
+        # level, rather than recursively, so that each yielded binding is not
+        # passed up through a generator per level of the tree
+        walks = [self._walk_impl(self._binding_tree, core.Path(), ancestor_node_values, result_graph)]
+        while walks:
+            for child_binding_node, resolved_layout_path, attribute_map, child_ancestor_node_values in walks[-1]:
+                yield child_binding_node.binding(), resolved_layout_path, attribute_map
+                if child_binding_node.has_children():
+                    walks.append(self._walk_impl(
+                        child_binding_node,
+                        resolved_layout_path,
+                        child_ancestor_node_values,
+                        result_graph,
+                    ))
+                    break
+            else:
+                walks.pop()
 
     def _walk_impl(self, parent_binding_node: bindings.BindingTree,
                    parent_resolved_layout_path: core.Path,
                    ancestor_node_values: datagraph.NodeValues,
                    result_graph: datagraph.ResultGraph) \
-            -> typing.Iterable[typing.Tuple[bindings.Binding, core.Path, utils.AttributeMap]]:
+            -> typing.Iterable[typing.Tuple[bindings.BindingTree, core.Path, utils.AttributeMap, datagraph.NodeValues]]:
         """
-        Yields bindings, their corresponding path in the final layout tree,
-        and a map of attribute values to update the element with.
+        Yields the child binding nodes of the given binding node for each of
+        their values, along with their corresponding path in the final layout
+        tree, a map of attribute values to update the element with, and the
+        ancestor values to walk the binding node's children with.
+
+        The children of each yielded binding node are expected to be walked
+        (see _walk()) before the next one is yielded.
         """
         # Yes, this is an ugly function. I do not currently know how to do
         # better, since we need to simultaneously walk a binding tree and
@@ -192,109 +267,195 @@ class DynamicVisualization:
         # values in each result, but nevertheless, this is slower than it
         # should be.
         # FIXME: ^ See above
-        if parent_binding_node.is_root():
-            parent_layout_path = core.Path()
-        else:
-            parent_layout_path = parent_binding_node.binding().layout_path()  # type: ignore
-
         for child_binding_node in parent_binding_node:
-            child_binding = child_binding_node.binding()
-            child_data_path = child_binding.data_path()
+            plan = self._binding_plan(child_binding_node)
+            child_binding = plan.binding
+            child_data_path = plan.data_path
             logger.info("Processing bindings of %s (%s)", child_data_path, child_binding.layout_path())
 
-            intermediate_layout_path = (child_binding.layout_path() - parent_layout_path)
-            seen_values = collections.defaultdict(lambda: 0)
+            resolved_layout_path_prefix = parent_resolved_layout_path + plan.intermediate_layout_path_prefix
+            instance_name_prefix = plan.instance_name_prefix
+            attr_bindings = plan.attr_bindings
+            # Mangled values to how many times they were seen, so instances of
+            # values that mangle the same get distinct names
+            seen_values: typing.Dict[str, int] = {}
 
             result = result_graph.result(child_data_path)
             node = result.node()
-            node_values = self._query_values(child_binding, result, ancestor_node_values)
-
-            def resolve_layout_path(_value: typing.Optional[typing.Any] = None):
-                value_path_part = mangle_value_into_path_part(_value)
-                seen_values[value_path_part] += 1
-                return (
-                    parent_resolved_layout_path
-                    + intermediate_layout_path.without_last()
-                    + (intermediate_layout_path.last()
-                       + "_" + value_path_part
-                       + "_" + str(seen_values[value_path_part]))
-                )
-
-            def apply_value_to_binding(_value, _was_not_filtered_out):
+            node_adaptations = self._node_adaptations.get(node)
+            if node_adaptations is None:
+                # adaptors_from() looks through all the data graph's adaptors
+                node_adaptations = [(adaptor.adapt_node(node), adaptor.adapt_value)
+                                    for adaptor in self._data_graph.adaptors_from(node)]
+                self._node_adaptations[node] = node_adaptations
+            # Drop the values a filter on the bound data node itself filters
+            # out here, rather than querying the filter for each value (see
+            # _check_if_filtered_out)
+            filters_own_values = plan.filters_own_values
+            node_values = self._query_values(child_binding, result, ancestor_node_values, filters_own_values)
+
+            def apply_value_to_binding(_value):
+                """
+                Returns what _walk_impl() yields for the value, or None if the
+                value got filtered out.
+                """
                 _new_ancestor_node_values = ancestor_node_values.copy()
                 # If the element binding fails, but keep_when_filtered_out was
                 # True or the binding matches null
                 if _value is not None:
                     in_null_binding = False
                     _new_ancestor_node_values[node] = _value
-                    for _adaptor in self._data_graph.adaptors_from(node):
-                        _new_ancestor_node_values[_adaptor.adapt_node(node)] = _adaptor.adapt_value(_value)
+                    for _adapted_node, _adapt_value in node_adaptations:
+                        _new_ancestor_node_values[_adapted_node] = _adapt_value(_value)
                 else:
                     in_null_binding = True
 
-                _is_filtered_out = self._check_if_filtered_out(
+                _is_filtered_out = not filters_own_values and self._check_if_filtered_out(
                     child_binding,
                     _new_ancestor_node_values,
                     result_graph,
                     in_null_binding,
                 )
                 if _is_filtered_out:
-                    logger.debug("%s with %s got filtered out", node, _value)
-                    _was_not_filtered_out[0] = False
-                    return
+                    if self._log_debug:
+                        logger.debug("%s with %s got filtered out", node, _value)
+                    return None
 
                 _has_missing_values, _attribute_map = self._query_attribute_bindings(
-                    child_binding.attr_bindings(),
+                    attr_bindings,
                     _new_ancestor_node_values,
                     result_graph,
                     in_null_binding,
                 )
                 if _has_missing_values:
-                    logger.debug("%s with %s got filtered out due to missing attribute values", node, _value)
-                    _was_not_filtered_out[0] = False
-                    return
-
-                _resolved_layout_path = resolve_layout_path(_value)
-                yield child_binding, _resolved_layout_path, _attribute_map
-                yield from self._walk_impl(
-                    child_binding_node,
-                    _resolved_layout_path,
-                    _new_ancestor_node_values,
-                    result_graph,
+                    if self._log_debug:
+                        logger.debug("%s with %s got filtered out due to missing attribute values", node, _value)
+                    return None
+
+                _value_path_part = mangle_value_into_path_part(_value)
+                _seen_count = seen_values.get(_value_path_part, 0) + 1
+                seen_values[_value_path_part] = _seen_count
+                _resolved_layout_path = resolved_layout_path_prefix + (
+                    instance_name_prefix + _value_path_part + "_" + str(_seen_count)
                 )
-                _was_not_filtered_out[0] = True
-                return
+                return child_binding_node, _resolved_layout_path, _attribute_map, _new_ancestor_node_values
 
-            logger.debug("Got %s (%s) values %s", node, child_binding, node_values)
-            was_not_filtered_out_param = [True]
+            if self._log_debug:
+                logger.debug("Got %s (%s) values %s", node, child_binding, node_values)
             any_values_matched = False
             for node_value in node_values:
-                # Cannot return a value from a iterator after done, so this is
-                # my hack for an out parameter. We could collect the values,
-                # but with large subtrees that forces the tree to be built all
-                # at once at the end, which harms debugability.
-                yield from apply_value_to_binding(node_value, was_not_filtered_out_param)
-                any_values_matched |= was_not_filtered_out_param[0]
+                # Applied one value at a time (rather than for all values up
+                # front), so that each value's subtree is walked before the
+                # next value is queried; with large subtrees, that would
+                # otherwise force the tree to be built all at once at the end,
+                # which harms debugability.
+                walked = apply_value_to_binding(node_value)
+                if walked is not None:
+                    any_values_matched = True
+                    yield walked
 
             if not any_values_matched and child_binding.keep_when_filtered_out():
-                logger.debug("Continuing %s despite being filtered out", node)
-                yield from apply_value_to_binding(None, [None])
+                if self._log_debug:
+                    logger.debug("Continuing %s despite being filtered out", node)
+                walked = apply_value_to_binding(None)
+                if walked is not None:
+                    yield walked
 
-    @staticmethod
-    def _query_values(binding: bindings.Binding,
+    def _binding_plan(self, binding_node: bindings.BindingTree) -> _BindingPlan:
+        """
+        Returns what walking the given (non-root) binding node needs to know
+        about its binding. The binding tree does not change, so this is only
+        computed once per binding node, rather than for each parent value in
+        each walk.
+        """
+        plan = self._binding_plans.get(binding_node)
+        if plan is not None:
+            return plan
+
+        binding = binding_node.binding()
+        parent_binding_node = binding_node.parent()
+        if parent_binding_node.is_root():
+            parent_layout_path = core.Path()
+        else:
+            parent_layout_path = parent_binding_node.binding().layout_path()  # type: ignore
+
+        intermediate_layout_path = binding.layout_path() - parent_layout_path
+        data_path = binding.data_path()
+        binding_filter = binding.filter()
+        plan = _BindingPlan(
+            binding=binding,
+            data_path=data_path,
+            # Copied by attr_bindings()
+            attr_bindings=binding.attr_bindings(),
+            intermediate_layout_path_prefix=intermediate_layout_path.without_last(),
+            instance_name_prefix=intermediate_layout_path.last() + "_",
+            filters_own_values=binding_filter is not None and binding_filter.data_path == data_path,
+        )
+        self._binding_plans[binding_node] = plan
+        return plan
+
+    def _query_result_values(self, data_path: core.Path,
+                             result: datagraph.Result,
+                             ancestor_node_values: datagraph.NodeValues) -> typing.List[typing.Any]:
+        """
+        Returns result.values(ancestor_node_values), where result is the
+        result of the given data path. Bindings are queried once per value of
+        their ancestors, often with the same ancestor values (e.g. by an
+        attribute binding and a filter), so the values are only queried once
+        per walk for the same ancestor values.
+        """
+        try:
+            key = (data_path, frozenset(ancestor_node_values.items()))
+            values_and_added_node_values = self._values_cache.get(key)
+        except TypeError:  # unhashable value
+            return list(result.values(ancestor_node_values))
+
+        if values_and_added_node_values is None:
+            prior_node_values = ancestor_node_values.copy()
+            values = list(result.values(ancestor_node_values))
+            # Some results add to the given ancestor values (see
+            # datagraph.AdaptedResult), so do the same when reusing the values
+            added_node_values = {
+                node: value for node, value in ancestor_node_values.items()
+                if node not in prior_node_values or prior_node_values[node] != value
+            }
+            values_and_added_node_values = (values, added_node_values)
+            self._values_cache[key] = values_and_added_node_values
+        else:
+            ancestor_node_values.update(values_and_added_node_values[1])
+
+        return list(values_and_added_node_values[0])
+
+    def _query_values(self, binding: bindings.Binding,
                       result: datagraph.Result,
-                      ancestor_node_values: datagraph.NodeValues) -> typing.List[typing.Any]:
-        node_values = list(result.values(ancestor_node_values))
+                      ancestor_node_values: datagraph.NodeValues,
+                      apply_filter: bool = False) -> typing.List[typing.Any]:
+        """
+        Returns the values of the given binding's result. If apply_filter,
+        the values the binding's filter (which must be on the bound data
+        node) does not keep are left out.
+        """
+        node_values = self._query_result_values(binding.data_path(), result, ancestor_node_values)
         if binding.matches_null():
             if len(node_values) == 0:
                 node_values = [None]
             else:
                 node_values = []
 
-        return node_values[:binding.limit()]
+        # The limit applies before filtering, as with _check_if_filtered_out()
+        node_values = node_values[:binding.limit()]
+        if apply_filter:
+            binding_filter = binding.filter()
+            assert binding_filter is not None
+            if self._log_debug:
+                logger.debug("Filtering values with filter %s", binding_filter)
+            # None is a null binding, which filters do not apply to
+            node_values = [value for value in node_values
+                           if value is None or binding_filter.should_keep(str(value))]
 
-    @staticmethod
-    def _query_attribute_binding(attr_binding: bindings.AttributeBinding,
+        return node_values
+
+    def _query_attribute_binding(self, attr_binding: bindings.AttributeBinding,
                                  ancestor_node_values: datagraph.NodeValues,
                                  result_graph: datagraph.ResultGraph,
                                  in_null_binding: bool,
@@ -306,7 +467,7 @@ class DynamicVisualization:
                     value = attr_binding.apply_default(binding_id)
                 else:
                     result = result_graph.result(attr_data_path)
-                    result_values = list(result.values(ancestor_node_values))
+                    result_values = self._query_result_values(attr_data_path, result, ancestor_node_values)
                     if not result_values:
                         # This might fail if no default is set
                         value = attr_binding.apply_default(binding_id)
@@ -337,7 +498,8 @@ class DynamicVisualization:
                 value = self._query_attribute_binding(attr_binding, ancestor_node_values, result_graph,
                                                       in_null_binding, self._transformation_map)
             except ValueError as err:
-                logger.debug("Transformation on %s failed: %s", attr_binding, err)
+                if self._log_debug:
+                    logger.debug("Transformation on %s failed: %s", attr_binding, err)
                 return True, {}
             except tr.TransformationError as err:
                 raise RuntimeError("Failed to get attribute bindings for {} (with ancestor values {}): {}".format(
@@ -350,8 +512,7 @@ class DynamicVisualization:
 
         return False, attribute_map
 
-    @staticmethod
-    def _check_if_filtered_out(binding: bindings.Binding,
+    def _check_if_filtered_out(self, binding: bindings.Binding,
                                ancestor_node_values: datagraph.NodeValues,
                                result_graph: datagraph.ResultGraph,
                                in_null_binding: bool) -> bool:
@@ -360,8 +521,9 @@ class DynamicVisualization:
 
         binding_filter = binding.filter()
         result = result_graph.result(binding_filter.data_path)
-        values = list(result.values(ancestor_node_values))
-        logger.debug("Got values for filter %s: %s", binding_filter, values)
+        values = self._query_result_values(binding_filter.data_path, result, ancestor_node_values)
+        if self._log_debug:
+            logger.debug("Got values for filter %s: %s", binding_filter, values)
         if len(values) == 0:
             return not binding_filter.does_match_null()
 